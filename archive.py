@@ -0,0 +1,245 @@
+# archive.py
+# Cold storage for old messages.
+#
+# Messages older than their conversation's hot window (retention.hot_days,
+# or HOT_DAYS) move out of the messages table into append-only segment
+# files under ARCHIVE_DIR/<YYYY-MM>/, partitioned by the month they were
+# sent. A segment is MAGIC, then zlib-compressed blocks, then a JSON footer
+# and its 8-byte length. Each block holds up to BLOCK_MESSAGES messages of
+# one conversation in id order. archive_segments and archive_blocks index
+# the blocks by conversation and id range, so a page of history inflates
+# one or two blocks. Segments are never modified once written; the footer
+# repeats the block index, so each file describes itself.
+#
+# Within a conversation every archived id is below every hot id, so paging
+# can read the hot table first and continue in the archive.
+#
+# A batch is moved by writing and fsyncing its segment files, then indexing
+# them and deleting the rows from messages in one transaction. A crash in
+# between leaves an unindexed file and loses nothing.
+#
+# The server runs a pass every ARCHIVE_INTERVAL seconds (0 disables it).
+# One pass by hand: python archive.py [database]
+
+import os
+import sys
+import json
+import zlib
+import time
+import uuid
+import fcntl
+import struct
+import asyncio
+import logging
+from functools import lru_cache
+from typing import Dict, List
+
+from metrics import Counter
+
+ARCHIVE_DIR = os.environ.get("RUBYRUBY_ARCHIVE_DIR", "")   # default: archive/ beside the database
+HOT_DAYS = int(os.environ.get("RUBYRUBY_HOT_DAYS", "90"))
+ARCHIVE_INTERVAL = float(os.environ.get("RUBYRUBY_ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH = 5000    # messages moved per transaction
+BLOCK_MESSAGES = 1000   # messages per compressed block
+CACHE_BLOCKS = 64       # inflated blocks kept in memory
+MAGIC = b"RRSEG1\n"
+
+logger = logging.getLogger("rubyruby.archive")
+
+ARCHIVED = Counter("rubyruby_messages_archived_total", "Messages moved from the hot table to archive segments.")
+
+def default_dir(db_path: str) -> str:
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(db_path)), "archive")
+
+# ---------------- Reading ----------------
+# Rows are [id, sender, target_type, target, text, ts], the export format.
+
+@lru_cache(maxsize=CACHE_BLOCKS)
+def read_block(path: str, offset: int, length: int) -> tuple:
+    # Segments are immutable, so an inflated block never goes stale.
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return tuple(json.loads(zlib.decompress(data)))
+
+class Archive:
+    """Read side of the archive; every method takes a database connection."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def blocks(self, conn, sql: str, args: tuple):
+        for path, offset, length in conn.execute(f"""
+            SELECT s.path, b.offset, b.length FROM archive_blocks b
+            JOIN archive_segments s ON s.id = b.segment_id
+            {sql}
+        """, args).fetchall():
+            yield read_block(os.path.join(self.directory, path), offset, length)
+
+    def before(self, conn, conv: str, before_id: int, limit: int) -> List[list]:
+        """Up to limit archived messages of conv below before_id, newest first."""
+        out = []
+        for block in self.blocks(conn, "WHERE b.conv=? AND b.first_id<? ORDER BY b.last_id DESC", (conv, before_id)):
+            for row in reversed(block):
+                if row[0] < before_id:
+                    out.append(row)
+                    if len(out) >= limit:
+                        return out
+        return out
+
+    def after(self, conn, conv: str, after_id: int, limit: int) -> List[list]:
+        """Up to limit archived messages of conv above after_id, oldest first."""
+        out = []
+        for block in self.blocks(conn, "WHERE b.conv=? AND b.last_id>? ORDER BY b.first_id", (conv, after_id)):
+            for row in block:
+                if row[0] > after_id:
+                    out.append(row)
+                    if len(out) >= limit:
+                        return out
+        return out
+
+    def has_after(self, conn, conv: str, after_id: int) -> bool:
+        return conn.execute("SELECT 1 FROM archive_blocks WHERE conv=? AND last_id>? LIMIT 1",
+                            (conv, after_id)).fetchone() is not None
+
+# ---------------- Writing ----------------
+def month_of(ts) -> str:
+    return ts[:7] if isinstance(ts, str) and len(ts) >= 7 and ts[4] == "-" else "undated"
+
+def write_segment(directory: str, month: str, convs: Dict[str, List[list]]):
+    """Write one segment file; returns its path relative to directory and
+    its blocks as (conv, first_id, last_id, count, offset, length)."""
+    ids = [row[0] for rows in convs.values() for row in rows]
+    rel = os.path.join(month, f"{min(ids):012d}-{max(ids):012d}-{uuid.uuid4().hex[:8]}.seg")
+    path = os.path.join(directory, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    blocks = []
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC)
+        for conv in sorted(convs):
+            rows = convs[conv]
+            for i in range(0, len(rows), BLOCK_MESSAGES):
+                chunk = rows[i:i + BLOCK_MESSAGES]
+                data = zlib.compress(json.dumps(chunk, separators=(",", ":")).encode())
+                blocks.append((conv, chunk[0][0], chunk[-1][0], len(chunk), f.tell(), len(data)))
+                f.write(data)
+        footer = json.dumps(blocks).encode()
+        f.write(footer + struct.pack(">Q", len(footer)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return rel, blocks
+
+def fetch_archivable(conn, conv: str, cutoff: str, after_id: int, limit: int):
+    # Oldest messages of conv from after_id on, up to the first one inside
+    # the hot window, so the archive never gets an id above a hot one.
+    rows = conn.execute("""
+        SELECT id, sender, target_type, target, text, ts FROM messages
+        WHERE conv=? AND id>? ORDER BY id LIMIT ?
+    """, (conv, after_id, limit)).fetchall()
+    out = []
+    for row in rows:
+        # A ts that isn't text has no age to compare; such rows go to the
+        # "undated" segment rather than stopping every pass here.
+        if isinstance(row[5], str) and row[5] >= cutoff:
+            return out, True
+        out.append(list(row))
+    return out, len(rows) < limit
+
+class Archiver:
+    """Moves messages past their hot window into segment files."""
+
+    def __init__(self, db, archive: Archive, default_days: int = HOT_DAYS,
+                 interval: float = ARCHIVE_INTERVAL, batch: int = ARCHIVE_BATCH):
+        self.db = db
+        self.archive = archive
+        self.default_days = default_days
+        self.interval = interval
+        self.batch = batch
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                moved = await asyncio.to_thread(self.run_once)
+                if moved:
+                    logger.info("archived %d messages", moved)
+            except Exception as e:
+                logger.warning("archiving failed: %r", e)
+
+    def run_once(self) -> int:
+        # With several workers, whoever holds the lock does the pass.
+        os.makedirs(self.archive.directory, exist_ok=True)
+        with open(os.path.join(self.archive.directory, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            return self.archive_all()
+
+    def archive_all(self) -> int:
+        with self.db.reader("archive_scan") as conn:
+            convs = conn.execute("""
+                SELECT c.conv, coalesce(r.hot_days, ?) FROM conversations c
+                LEFT JOIN retention r ON r.conv = c.conv
+            """, (self.default_days,)).fetchall()
+        now = time.time()
+        moved = 0
+        pending: List[tuple] = []
+        for conv, days in convs:
+            cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - days * 86400))
+            after_id, done = 0, False
+            while not done:
+                with self.db.reader("fetch_archivable") as conn:
+                    rows, done = fetch_archivable(conn, conv, cutoff, after_id, self.batch)
+                pending.extend((conv, row) for row in rows)
+                if rows:
+                    after_id = rows[-1][0]
+                if len(pending) >= self.batch:
+                    moved += self.move(pending)
+                    pending = []
+        if pending:
+            moved += self.move(pending)
+        return moved
+
+    def move(self, pending: List[tuple]) -> int:
+        months: Dict[str, Dict[str, List[list]]] = {}
+        for conv, row in pending:
+            months.setdefault(month_of(row[5]), {}).setdefault(conv, []).append(row)
+        written = []
+        try:
+            for month, convs in sorted(months.items()):
+                rel, blocks = write_segment(self.archive.directory, month, convs)
+                written.append((month, rel, blocks))
+            with self.db.writer("archive_move") as conn:
+                for month, rel, blocks in written:
+                    cur = conn.execute("""
+                        INSERT INTO archive_segments (month, path, first_id, last_id, count, bytes)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (month, rel, min(b[1] for b in blocks), max(b[2] for b in blocks), sum(b[3] for b in blocks),
+                          os.path.getsize(os.path.join(self.archive.directory, rel))))
+                    conn.executemany("""
+                        INSERT INTO archive_blocks (conv, segment_id, first_id, last_id, count, offset, length)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, [(b[0], cur.lastrowid) + tuple(b[1:]) for b in blocks])
+                conn.executemany("DELETE FROM messages WHERE id=?", [(row[0],) for _, row in pending])
+        except BaseException:
+            for _, rel, _ in written:
+                try:
+                    os.unlink(os.path.join(self.archive.directory, rel))
+                except OSError:
+                    pass
+            raise
+        ARCHIVED.inc(amount=len(pending))
+        return len(pending)
+
+if __name__ == "__main__":
+    from db import DB_FILE, Database
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else DB_FILE
+    print(f"archived {Archiver(Database(path, readers=1), Archive(default_dir(path))).run_once()} messages")
@@ -0,0 +1,106 @@
+# attachments.py
+# File attachments, stored once per content.
+#
+# An upload is streamed into ATTACHMENT_DIR/tmp/ while its SHA-256 is
+# computed, then renamed to blobs/<aa>/<bb>/<sha256>. When that blob exists
+# already the upload is discarded, so the same bytes take disk space once
+# however often they are uploaded. Each upload still gets its own row in
+# attachments (id, name, content type, uploader); messages reference rows
+# by id through message_attachments, and forwarding a file is just another
+# message referencing the same id.
+#
+# Memory stays bounded on both sides: the upload is written and hashed a
+# WRITE_CHUNK at a time on a worker thread, and downloads are FileResponses,
+# which read the blob in chunks, answer Range requests with 206 and hand the
+# whole file to the server when it offers the ASGI pathsend extension.
+#
+# A blob is fsynced before it is renamed into place and before its row is
+# committed, so a row never names a missing or partial blob. A crash mid-
+# upload leaves a file in tmp/ and nothing else.
+
+import os
+import uuid
+import asyncio
+import hashlib
+from typing import AsyncIterable, Tuple
+
+from metrics import Counter
+
+ATTACHMENT_DIR = os.environ.get("RUBYRUBY_ATTACHMENT_DIR", "")   # default: attachments/ beside the database
+MAX_ATTACHMENT = int(os.environ.get("RUBYRUBY_MAX_ATTACHMENT", str(100 * 1024 * 1024)))   # bytes per file
+MAX_ATTACHMENTS = 10          # attachments per message
+MAX_NAME = 255                # characters kept of a file name
+WRITE_CHUNK = 1024 * 1024     # bytes buffered before a write to disk
+
+UPLOADED = Counter("rubyruby_attachment_upload_bytes_total", "Bytes received in attachment uploads.")
+DEDUPLICATED = Counter("rubyruby_attachment_deduplicated_total", "Uploads whose content was already stored.")
+
+def attachment_dir(db_path: str) -> str:
+    return ATTACHMENT_DIR or os.path.join(os.path.dirname(os.path.abspath(db_path)), "attachments")
+
+def clean_name(name: str) -> str:
+    # Only the last path component, without control characters; the name is
+    # shown to other users and sent back in Content-Disposition.
+    name = os.path.basename(name.replace("\\", "/"))
+    return "".join(ch for ch in name if ord(ch) >= 32)[:MAX_NAME]
+
+def write_chunk(f, digest, data: bytes):
+    digest.update(data)
+    f.write(data)
+
+def fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Store:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, "blobs", sha256[:2], sha256[2:4], sha256)
+
+    async def save(self, chunks: AsyncIterable[bytes], limit: int = MAX_ATTACHMENT) -> Tuple[str, int, bool]:
+        """Store a stream; returns (sha256, size, whether the blob is new).
+        Raises ValueError past limit bytes."""
+        tmp_dir = os.path.join(self.directory, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp = os.path.join(tmp_dir, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        buf = bytearray()
+        f = open(tmp, "wb")
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError(f"attachments are limited to {limit} bytes")
+                UPLOADED.inc(amount=len(chunk))
+                buf += chunk
+                if len(buf) >= WRITE_CHUNK:
+                    data, buf = bytes(buf), bytearray()
+                    await asyncio.to_thread(write_chunk, f, digest, data)
+            await asyncio.to_thread(write_chunk, f, digest, bytes(buf))
+            sha256 = digest.hexdigest()
+            new = await asyncio.to_thread(self.commit, f, tmp, sha256)
+        finally:
+            f.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        if not new:
+            DEDUPLICATED.inc()
+        return sha256, size, new
+
+    def commit(self, f, tmp: str, sha256: str) -> bool:
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            return False
+        f.flush()
+        os.fsync(f.fileno())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Identical uploads racing here rename the same bytes over each other.
+        os.rename(tmp, path)
+        fsync_dir(os.path.dirname(path))
+        return True
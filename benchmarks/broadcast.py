@@ -0,0 +1,120 @@
+# benchmarks/broadcast.py
+# Delivery latency of one group message versus group size, comparing the
+# old broadcast_group (DB query per message, sequential sends, json.dumps
+# per recipient) with the current WSManager.broadcast_group.
+#
+# Execute: python benchmarks/broadcast.py [--sizes 10,100,500,1000] [--slow 1]
+#
+# Recipients are in-process fake sockets whose send takes --send-ms; --slow
+# of them take --slow-ms instead, standing in for clients on a bad link.
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CWD = os.getcwd()
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="rubyruby-bench-"))
+
+import server  # noqa: E402  (creates its database in the temp dir)
+
+class FakeSocket:
+    def __init__(self, delay: float, arrivals: list):
+        self.delay = delay
+        self.arrivals = arrivals
+
+    async def send_text(self, data: str):
+        await asyncio.sleep(self.delay)
+        self.arrivals.append(time.perf_counter())
+
+async def legacy_broadcast(sockets: dict, group_id: str, message: dict):
+    # broadcast_group as it was before the membership index.
+    with server.db.reader() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT username FROM group_members WHERE group_id=?", (group_id,))
+        members = [r[0] for r in cur.fetchall()]
+    for m in members:
+        ws = sockets.get(m)
+        if ws:
+            try:
+                await ws.send_text(json.dumps(message))
+            except Exception:
+                pass
+
+async def current_broadcast(sockets: dict, group_id: str, message: dict):
+    manager = server.WSManager()
+    await server.bus.start(manager.deliver, server.on_control)
+    for username, sock in sockets.items():
+        conn = server.Connection(username, sock)
+        conn.start()
+        manager.connections[username] = {conn}
+        server.bus.online(username)
+    await manager.broadcast_group(group_id, message)
+    return manager
+
+def setup_group(size: int) -> str:
+    with server.db.writer() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO groups (name) VALUES (?)", (f"bench-{size}",))
+        gid = cur.lastrowid
+        cur.executemany("INSERT INTO group_members (group_id, username) VALUES (?, ?)",
+                        [(gid, f"u{size}-{i}") for i in range(size)])
+    return str(gid)
+
+async def run_once(broadcast, gid: str, size: int, args) -> dict:
+    sockets, fast, slow = {}, [], []
+    for i in range(size):
+        is_slow = i < args.slow
+        sockets[f"u{size}-{i}"] = FakeSocket((args.slow_ms if is_slow else args.send_ms) / 1000, slow if is_slow else fast)
+    message = {"type": "message", "id": 1, "from": "u0", "to": gid, "text": "x" * args.text_len, "target_type": "group"}
+    start = time.perf_counter()
+    manager = await broadcast(sockets, gid, message)
+    # Delivery may continue after broadcast returns; wait for every recipient.
+    while len(fast) + len(slow) < size:
+        await asyncio.sleep(0.001)
+    total = (time.perf_counter() - start) * 1000
+    if manager:
+        conns = [c for cs in manager.connections.values() for c in cs]
+        for conn in conns:
+            manager.disconnect(conn)
+        await asyncio.gather(*(c.task for c in conns), return_exceptions=True)
+    lat = sorted((t - start) * 1000 for t in fast)
+    return {
+        "p50_ms": statistics.median(lat) if lat else 0.0,
+        "max_ms": lat[-1] if lat else 0.0,
+        "total_ms": total,
+    }
+
+async def main(args):
+    sizes = [int(s) for s in args.sizes.split(",")]
+    results = []
+    print(f"{'size':>6}  {'impl':>7}  {'p50 ms':>9}  {'max ms':>9}  {'total ms':>9}")
+    for size in sizes:
+        gid = setup_group(size)
+        impls = [("before", legacy_broadcast), ("after", current_broadcast)]
+        for name, fn in impls:
+            runs = [await run_once(fn, gid, size, args) for _ in range(args.repeat)]
+            row = {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+            row.update(size=size, impl=name)
+            results.append(row)
+            print(f"{size:>6}  {name:>7}  {row['p50_ms']:>9.2f}  {row['max_ms']:>9.2f}  {row['total_ms']:>9.2f}")
+    if args.output:
+        with open(os.path.join(CWD, args.output), "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--sizes", default="10,50,100,500,1000")
+    p.add_argument("--send-ms", type=float, default=0.2, help="send time of a normal recipient")
+    p.add_argument("--slow", type=int, default=1, help="number of slow recipients per group")
+    p.add_argument("--slow-ms", type=float, default=250.0, help="send time of a slow recipient")
+    p.add_argument("--text-len", type=int, default=200)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--output", help="write results as JSON to this path")
+    asyncio.run(main(p.parse_args()))
@@ -0,0 +1,350 @@
+# benchmarks/loadtest.py
+# Starts the server on a scratch database and drives it with simulated
+# users: WebSocket DM and group traffic plus HTTP history fetches.
+#
+# Execute: python benchmarks/loadtest.py --users 200 --duration 30 --output results.json
+#
+# Reports messages/sec, end-to-end delivery latency (send -> receive on the
+# recipient's socket), ack latency (send -> durable ack), HTTP route latency
+# percentiles, server RSS and bytes received over the WebSockets. --protocol
+# binary has the users speak the binary protocol instead of JSON. --abusers N
+# adds N more users that flood messages at --abuse-rate; their traffic is
+# not measured, only its effect on everyone else. --output writes the same numbers as JSON with
+# the git commit and configuration, so runs can be compared across commits.
+# --workers N above 1 also starts the bus broker, so messages cross workers.
+# Needs the websockets and httpx packages.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import PROTOCOL, decode_frame, encode_frame, encode_record  # noqa: E402
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))]
+    return {"count": len(s), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": s[-1]}
+
+def rss_kb(pid: int) -> int:
+    # Resident memory of the server and any worker processes it forked.
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.acked = 0
+        self.delivered = 0
+        self.errors = 0
+        self.throttled = 0
+        self.frames = 0
+        self.bytes = 0
+        self.delivery_ms = []
+        self.ack_ms = []
+        self.http_ms = {}
+        self.rss_kb = []
+        self.recording = False
+
+    def http(self, route: str, ms: float):
+        if self.recording:
+            self.http_ms.setdefault(route, []).append(ms)
+
+class User:
+    def __init__(self, name: str, args, stats: Stats, groups, abuser: bool = False):
+        self.name = name
+        self.abuser = abuser
+        self.args = args
+        self.stats = stats
+        self.groups = groups
+        self.token = name
+        self.pending = {}   # ref -> send time
+        self.ref = 0
+
+    @property
+    def auth(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def run(self, base: str, peers, stop: asyncio.Event):
+        url = base.replace("http", "ws", 1) + f"/ws/{self.token}"
+        binary = self.args.protocol == "binary"
+        async with websockets.connect(url, max_queue=None, compression=None,
+                                      subprotocols=[PROTOCOL] if binary else None) as ws:
+            reader = asyncio.create_task(self.receive(ws))
+            try:
+                while not stop.is_set():
+                    await asyncio.sleep(1 / self.args.abuse_rate if self.abuser else random.expovariate(self.args.rate))
+                    if stop.is_set():
+                        break
+                    self.ref += 1
+                    now = time.monotonic()
+                    if self.groups and random.random() >= self.args.dm_ratio:
+                        target_type, target = "group", random.choice(self.groups)
+                    else:
+                        target_type, target = "user", random.choice(peers)
+                    text = ("ab " if self.abuser else f"lt {now:.6f} ") + "x" * self.args.text_len
+                    msg = {"type": "message", "target_type": target_type, "target": target, "text": text, "ref": self.ref}
+                    await ws.send(encode_frame([encode_record(msg)]) if binary else json.dumps(msg))
+                    if self.abuser:
+                        continue
+                    self.pending[self.ref] = now
+                    if self.stats.recording:
+                        self.stats.sent += 1
+            finally:
+                reader.cancel()
+
+    async def flood(self, base: str, peers, stop: asyncio.Event):
+        # An abuser that gets disconnected comes straight back.
+        while not stop.is_set():
+            try:
+                await self.run(base, peers, stop)
+            except (websockets.ConnectionClosed, OSError):
+                await asyncio.sleep(0.1)
+
+    async def receive(self, ws):
+        async for raw in ws:
+            now = time.monotonic()
+            if self.stats.recording:
+                self.stats.frames += 1
+                self.stats.bytes += len(raw)
+            for msg in decode_frame(raw) if isinstance(raw, bytes) else [json.loads(raw)]:
+                t = msg.get("type")
+                if self.abuser:
+                    continue
+                if t == "ack":
+                    sent = self.pending.pop(msg.get("ref"), None)
+                    if sent is not None and self.stats.recording:
+                        self.stats.acked += 1
+                        self.stats.ack_ms.append((now - sent) * 1000)
+                elif t == "error":
+                    self.stats.errors += 1
+                elif t == "throttled" and self.stats.recording:
+                    self.pending.pop(msg.get("ref"), None)
+                    self.stats.throttled += 1
+                elif t == "message" and msg.get("from") != self.name:
+                    text = msg.get("text", "")
+                    if text.startswith("lt ") and self.stats.recording:
+                        self.stats.delivered += 1
+                        self.stats.delivery_ms.append((now - float(text.split()[1])) * 1000)
+
+async def timed(client: httpx.AsyncClient, stats: Stats, route: str, method: str, url: str, **kw):
+    t = time.monotonic()
+    r = await client.request(method, url, **kw)
+    stats.http(route, (time.monotonic() - t) * 1000)
+    r.raise_for_status()
+    return r.json()
+
+async def history_load(client, stats: Stats, users, args, stop: asyncio.Event):
+    # Conversation opens at --history-rate per second across all users, each
+    # in a DM or in one of the user's own groups.
+    while not stop.is_set():
+        await asyncio.sleep(random.expovariate(args.history_rate))
+        u = random.choice(users)
+        try:
+            if u.groups and random.random() < 0.5:
+                await timed(client, stats, "GET /messages (group)", "GET", f"/messages/{u.name}/group/{random.choice(u.groups)}",
+                            headers=u.auth)
+            else:
+                await timed(client, stats, "GET /messages (dm)", "GET", f"/messages/{u.name}/user/{random.choice(users).name}",
+                            headers=u.auth)
+            if random.random() < 0.2:
+                await timed(client, stats, "GET /contacts", "GET", f"/contacts/{u.name}", headers=u.auth)
+                await timed(client, stats, "GET /groups", "GET", f"/groups/{u.name}", headers=u.auth)
+        except httpx.HTTPError:
+            stats.errors += 1
+
+async def sample_rss(pid: int, stats: Stats, stop: asyncio.Event):
+    while not stop.is_set():
+        stats.rss_kb.append(rss_kb(pid))
+        await asyncio.sleep(0.5)
+
+async def setup(client, stats: Stats, args):
+    names = [f"lt{i}" for i in range(args.users)]
+    users = [User(n, args, stats, []) for n in names]
+    abusers = [User(f"ab{i}", args, stats, [], abuser=True) for i in range(args.abusers)]
+    sem = asyncio.Semaphore(32)
+    async def register(u):
+        async with sem:
+            await timed(client, stats, "POST /register", "POST", "/register", json={"username": u.name, "password": "pw"})
+            r = await timed(client, stats, "POST /login", "POST", "/login", json={"username": u.name, "password": "pw"})
+            u.token = r.get("token", u.name)
+    await asyncio.gather(*(register(u) for u in users + abusers))
+    groups = []
+    for g in range(args.groups):
+        members = random.sample(users, min(args.group_size, len(users)))
+        r = await timed(client, stats, "POST /create_group", "POST", "/create_group",
+                        json={"name": f"lt-{g}", "owner": members[0].name}, headers=members[0].auth)
+        gid = r["group_id"]
+        groups.append(gid)
+        async def join(u):
+            async with sem:
+                await timed(client, stats, "POST /join_group", "POST", "/join_group", json={"group_id": gid, "user": u.name},
+                            headers=u.auth)
+        await asyncio.gather(*(join(u) for u in members[1:]))
+        for u in members:
+            u.groups.append(gid)
+    for u in abusers:
+        u.groups = list(groups)
+    return users, abusers, groups
+
+def start_server(args, workdir: str):
+    """Returns the server process and, with several workers, the bus broker
+    they deliver to each other through."""
+    cmd = [sys.executable, "-m", "uvicorn", "server:app", "--app-dir", ROOT,
+           "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"]
+    env = dict(os.environ)
+    broker = None
+    if args.workers > 1:
+        sock = os.path.join(workdir, "bus.sock")
+        broker = subprocess.Popen([sys.executable, os.path.join(ROOT, "bus.py"), sock], cwd=workdir)
+        deadline = time.monotonic() + 5
+        while not os.path.exists(sock):
+            if broker.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("bus broker did not start")
+            time.sleep(0.05)
+        env["RUBYRUBY_BUS"] = f"unix:{sock}"
+        cmd += ["--workers", str(args.workers)]
+    return subprocess.Popen(cmd, cwd=workdir, env=env), broker
+
+async def wait_ready(base: str, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base) as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get("/metrics")
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def main(args):
+    random.seed(args.seed)
+    base = f"http://127.0.0.1:{args.port}"
+    workdir = tempfile.mkdtemp(prefix="rubyruby-load-")
+    proc, broker = start_server(args, workdir)
+    stats = Stats()
+    try:
+        await wait_ready(base)
+        limits = httpx.Limits(max_connections=64)
+        async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+            stats.recording = True   # setup routes are timed too
+            users, abusers, _ = await setup(client, stats, args)
+            stats.recording = False
+            stop = asyncio.Event()
+            names = [u.name for u in users]
+            tasks = [asyncio.create_task(u.run(base, [n for n in names if n != u.name] or names, stop)) for u in users]
+            tasks += [asyncio.create_task(u.flood(base, names, stop)) for u in abusers]
+            if args.history_rate > 0:
+                tasks.append(asyncio.create_task(history_load(client, stats, users, args, stop)))
+            tasks.append(asyncio.create_task(sample_rss(proc.pid, stats, stop)))
+            await asyncio.sleep(args.warmup)
+            stats.recording = True
+            start = time.monotonic()
+            await asyncio.sleep(args.duration)
+            stats.recording = False
+            elapsed = time.monotonic() - start
+            stop.set()
+            await asyncio.sleep(0.5)
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        if broker is not None:
+            broker.terminate()
+            broker.wait()
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "duration_s": elapsed,
+        "messages": {
+            "sent": stats.sent, "acked": stats.acked, "delivered": stats.delivered, "errors": stats.errors,
+            "throttled": stats.throttled,
+            "sent_per_s": stats.sent / elapsed, "delivered_per_s": stats.delivered / elapsed,
+        },
+        "ws_received": {"frames": stats.frames, "bytes": stats.bytes, "bytes_per_s": stats.bytes / elapsed},
+        "delivery_latency": percentiles(stats.delivery_ms),
+        "ack_latency": percentiles(stats.ack_ms),
+        "http": {route: percentiles(ms) for route, ms in sorted(stats.http_ms.items())},
+        "server_rss_kb": {"max": max(stats.rss_kb, default=0), "last": stats.rss_kb[-1] if stats.rss_kb else 0},
+    }
+    report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+def report(r):
+    m = r["messages"]
+    print(f"commit {r['commit']}  {r['duration_s']:.1f}s")
+    print(f"messages  sent {m['sent']} ({m['sent_per_s']:.0f}/s)  delivered {m['delivered']} ({m['delivered_per_s']:.0f}/s)  "
+          f"errors {m['errors']}  throttled {m['throttled']}")
+    w = r["ws_received"]
+    print(f"ws received  {w['frames']} frames  {w['bytes'] / 1024:.0f} KiB ({w['bytes_per_s'] / 1024:.1f} KiB/s)")
+    for name in ("delivery_latency", "ack_latency"):
+        p = r[name]
+        if p["count"]:
+            print(f"{name:<22} p50 {p['p50_ms']:8.2f}  p95 {p['p95_ms']:8.2f}  p99 {p['p99_ms']:8.2f} ms")
+    for route, p in r["http"].items():
+        if p["count"]:
+            print(f"{route:<22} p50 {p['p50_ms']:8.2f}  p95 {p['p95_ms']:8.2f}  p99 {p['p99_ms']:8.2f} ms  (n={p['count']})")
+    print(f"server rss  max {r['server_rss_kb']['max'] / 1024:.1f} MiB")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--users", type=int, default=100, help="concurrent WebSocket users")
+    p.add_argument("--rate", type=float, default=1.0, help="messages per second per user")
+    p.add_argument("--dm-ratio", type=float, default=0.7, help="share of messages sent as DMs")
+    p.add_argument("--groups", type=int, default=10)
+    p.add_argument("--group-size", type=int, default=20)
+    p.add_argument("--abusers", type=int, default=0, help="extra users flooding messages, not measured")
+    p.add_argument("--abuse-rate", type=float, default=500.0, help="messages per second per abuser")
+    p.add_argument("--history-rate", type=float, default=20.0, help="history fetches per second, all users")
+    p.add_argument("--text-len", type=int, default=100)
+    p.add_argument("--protocol", choices=("json", "binary"), default="json", help="WebSocket protocol the users speak")
+    p.add_argument("--duration", type=float, default=20.0, help="measured seconds")
+    p.add_argument("--warmup", type=float, default=3.0)
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--output", help="write results as JSON to this path")
+    asyncio.run(main(p.parse_args()))
@@ -0,0 +1,306 @@
+# bus.py
+# Message delivery between server workers.
+#
+# One process:      nothing to configure, LocalBus is used.
+# Several workers:  python bus.py /tmp/rubyruby-bus.sock
+#                   RUBYRUBY_BUS=unix:/tmp/rubyruby-bus.sock uvicorn server:app --workers 4
+#
+# Every worker tells the bus which users have a socket on it. The broker
+# keeps that routing table and mirrors it to every worker, so a worker
+# publishes a frame only to the workers that hold one of its recipients,
+# and not at all when every recipient is offline. The same table answers
+# is_online() for presence, and the watch callback hears of every change.
+#
+# Frames published while a worker is cut off from the broker are lost, so
+# after every reconnect the worker sends {"type": "resync"} to its local
+# sessions and their clients refetch history. Neither side waits on a slow
+# peer: a connection whose unsent output passes BUFFER_LIMIT is aborted, and
+# the worker reconnects and resyncs like after any other outage.
+
+import os
+import sys
+import json
+import uuid
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, Optional, Set
+
+FRAME_LIMIT = 16 * 1024 * 1024   # longest line either side will read
+BUFFER_LIMIT = 4 * FRAME_LIMIT   # unsent bytes either side holds for its peer
+logger = logging.getLogger("rubyruby.bus")
+
+Deliver = Callable[[Iterable[str], str, Optional[int]], None]  # users, frame, message id
+Control = Callable[[dict], None]
+Watch = Callable[[Iterable[str]], None]   # users whose online state may have changed
+
+class Bus:
+    """Routes frames to users wherever their sockets are.
+
+    All methods are called from the event loop and never block; deliver()
+    and control() callbacks also run on the loop.
+    """
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+        self.control: Optional[Control] = None
+        self.watch: Optional[Watch] = None
+
+    async def start(self, deliver: Deliver, control: Control, watch: Optional[Watch] = None):
+        self.deliver = deliver
+        self.control = control
+        self.watch = watch
+
+    def notify(self, usernames: Iterable[str]):
+        if self.watch is not None:
+            self.watch(usernames)
+
+    async def stop(self):
+        pass
+
+    def online(self, username: str):
+        """The first local session of username opened."""
+
+    def offline(self, username: str):
+        """The last local session of username closed."""
+
+    def is_online(self, username: str) -> bool:
+        raise NotImplementedError
+
+    def publish(self, usernames: Iterable[str], data: str, msg_id: Optional[int] = None):
+        raise NotImplementedError
+
+    def broadcast_control(self, event: dict):
+        """Send event to the control callback of every other worker."""
+
+class LocalBus(Bus):
+    def __init__(self):
+        super().__init__()
+        self.users: Set[str] = set()
+
+    def online(self, username: str):
+        self.users.add(username)
+        self.notify((username,))
+
+    def offline(self, username: str):
+        self.users.discard(username)
+        self.notify((username,))
+
+    def is_online(self, username: str) -> bool:
+        return username in self.users
+
+    def publish(self, usernames: Iterable[str], data: str, msg_id: Optional[int] = None):
+        targets = [u for u in usernames if u in self.users]
+        if targets:
+            self.deliver(targets, data, msg_id)
+
+    def broadcast_control(self, event: dict):
+        pass
+
+# ---------------- Broker ----------------
+# Newline-delimited JSON over a Unix socket.
+#   worker -> broker: hello, online, offline, publish {"to": {worker: [users]}}, control
+#   broker -> worker: routes (full table), online, offline, deliver, control
+
+def write_frame(writer: asyncio.StreamWriter, frame: dict) -> bool:
+    """Queue frame without waiting; a peer that has stopped reading gets its
+    connection aborted instead of an ever-growing buffer."""
+    if writer.is_closing():
+        return False
+    if writer.transport.get_write_buffer_size() > BUFFER_LIMIT:
+        logger.warning("bus peer fell %d bytes behind, dropping it", writer.transport.get_write_buffer_size())
+        writer.transport.abort()
+        return False
+    writer.write(json.dumps(frame).encode() + b"\n")
+    return True
+
+class Broker:
+    def __init__(self, path: str):
+        self.path = path
+        self.workers: Dict[str, asyncio.StreamWriter] = {}
+        self.routes: Dict[str, Set[str]] = {}   # username -> worker ids
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path, limit=FRAME_LIMIT)
+        logger.info("bus broker listening on %s", self.path)
+        async with server:
+            await server.serve_forever()
+
+    def send_all(self, frame: dict, skip: Optional[str] = None):
+        for wid, w in self.workers.items():
+            if wid != skip:
+                write_frame(w, frame)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        wid = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                op = frame.get("op")
+                if op == "hello":
+                    wid = frame["worker"]
+                    self.workers[wid] = writer
+                    write_frame(writer, {"op": "routes", "routes": {u: sorted(ws) for u, ws in self.routes.items()}})
+                elif op == "online":
+                    self.routes.setdefault(frame["user"], set()).add(wid)
+                    self.send_all({"op": "online", "user": frame["user"], "worker": wid}, skip=wid)
+                elif op == "offline":
+                    self.drop_route(frame["user"], wid)
+                elif op == "publish":
+                    for target, users in frame["to"].items():
+                        w = self.workers.get(target)
+                        if w:
+                            write_frame(w, {"op": "deliver", "users": users, "data": frame["data"],
+                                            "id": frame.get("id")})
+                elif op == "control":
+                    self.send_all(frame, skip=wid)
+        except (ConnectionError, ValueError) as e:
+            logger.info("worker %s dropped: %r", wid, e)
+        finally:
+            if wid is not None and self.workers.get(wid) is writer:
+                del self.workers[wid]
+                for user in [u for u, ws in self.routes.items() if wid in ws]:
+                    self.drop_route(user, wid)
+            writer.close()
+
+    def drop_route(self, user: str, wid: str):
+        workers = self.routes.get(user)
+        if workers is None:
+            return
+        workers.discard(wid)
+        if not workers:
+            del self.routes[user]
+        self.send_all({"op": "offline", "user": user, "worker": wid}, skip=wid)
+
+class BrokerBus(Bus):
+    """Bus backed by a Broker on a Unix socket; reconnects if it goes away."""
+
+    RETRY_MAX = 5.0
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.local: Set[str] = set()
+        self.routes: Dict[str, Set[str]] = {}   # username -> remote worker ids
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver, control: Control, watch: Optional[Watch] = None):
+        await super().start(deliver, control, watch)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.writer:
+            self.writer.close()
+
+    def send(self, frame: dict):
+        if self.writer is not None:
+            write_frame(self.writer, frame)
+
+    async def run(self):
+        delay = 0.1
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=FRAME_LIMIT)
+            except OSError as e:
+                logger.warning("bus broker at %s unavailable: %r", self.path, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.RETRY_MAX)
+                continue
+            delay = 0.1
+            self.writer = writer
+            self.send({"op": "hello", "worker": self.worker_id})
+            for user in self.local:
+                self.send({"op": "online", "user": user})
+            if self.local:
+                # Whatever was published to them while disconnected is gone.
+                self.deliver(list(self.local), json.dumps({"type": "resync"}), None)
+            try:
+                await self.receive(reader)
+            except (ConnectionError, ValueError) as e:
+                logger.warning("bus connection lost: %r", e)
+            finally:
+                self.writer = None
+                lost, self.routes = list(self.routes), {}
+                self.notify(lost)
+                writer.close()
+
+    async def receive(self, reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            frame = json.loads(line)
+            op = frame.get("op")
+            if op == "deliver":
+                self.deliver(frame["users"], frame["data"], frame.get("id"))
+            elif op == "online":
+                self.routes.setdefault(frame["user"], set()).add(frame["worker"])
+                self.notify((frame["user"],))
+            elif op == "offline":
+                workers = self.routes.get(frame["user"])
+                if workers is not None:
+                    workers.discard(frame["worker"])
+                    if not workers:
+                        del self.routes[frame["user"]]
+                self.notify((frame["user"],))
+            elif op == "routes":
+                before = set(self.routes)
+                self.routes = {u: set(ws) - {self.worker_id} for u, ws in frame["routes"].items()}
+                self.routes = {u: ws for u, ws in self.routes.items() if ws}
+                self.notify(before | set(self.routes))
+            elif op == "control":
+                self.control(frame["event"])
+
+    def online(self, username: str):
+        self.local.add(username)
+        self.send({"op": "online", "user": username})
+        self.notify((username,))
+
+    def offline(self, username: str):
+        self.local.discard(username)
+        self.send({"op": "offline", "user": username})
+        self.notify((username,))
+
+    def is_online(self, username: str) -> bool:
+        return username in self.local or username in self.routes
+
+    def publish(self, usernames: Iterable[str], data: str, msg_id: Optional[int] = None):
+        local = []
+        remote: Dict[str, list] = {}
+        for u in usernames:
+            if u in self.local:
+                local.append(u)
+            for wid in self.routes.get(u, ()):
+                remote.setdefault(wid, []).append(u)
+        if local:
+            self.deliver(local, data, msg_id)
+        if remote:
+            self.send({"op": "publish", "to": remote, "data": data, "id": msg_id})
+
+    def broadcast_control(self, event: dict):
+        self.send({"op": "control", "event": event})
+
+def create_bus(url: Optional[str] = None) -> Bus:
+    url = url if url is not None else os.environ.get("RUBYRUBY_BUS", "")
+    if not url:
+        return LocalBus()
+    if url.startswith("unix:"):
+        return BrokerBus(url[len("unix:"):])
+    raise ValueError(f"unsupported RUBYRUBY_BUS: {url}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else "/tmp/rubyruby-bus.sock"
+    asyncio.run(Broker(path).serve())
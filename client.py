@@ -1,320 +1,632 @@
-# rubyruby_client_render.py
-import sys, os, json, requests
-from PyQt5 import QtWidgets, QtCore
-from websocket import WebSocketApp
-import threading
-
-SERVER = "https://rubyruby-server.onrender.com"
-WS_SERVER = "wss://rubyruby-server.onrender.com/ws"
-TOKEN_FILE = "user_token.json"
-
-# ---------------- TOKEN ----------------
-def load_token():
-    if os.path.exists(TOKEN_FILE):
-        try:
-            with open(TOKEN_FILE, "r") as f:
-                data = json.load(f)
-                return data.get("username"), data.get("token")
-        except:
-            return None, None
-    return None, None
-
-def save_token(username, token):
-    with open(TOKEN_FILE, "w") as f:
-        json.dump({"username": username, "token": token}, f)
-
-# ---------------- LOGIN DIALOG ----------------
-class LoginDialog(QtWidgets.QDialog):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("Rubyruby — Login / Registro")
-        self.username = None
-        layout = QtWidgets.QVBoxLayout(self)
-
-        tabs = QtWidgets.QTabWidget()
-        layout.addWidget(tabs)
-
-        # Login
-        tab_login = QtWidgets.QWidget()
-        tabs.addTab(tab_login, "Login")
-        lv = QtWidgets.QFormLayout(tab_login)
-        self.login_user = QtWidgets.QLineEdit()
-        self.login_pass = QtWidgets.QLineEdit()
-        self.login_pass.setEchoMode(QtWidgets.QLineEdit.Password)
-        lv.addRow("Usuário", self.login_user)
-        lv.addRow("Senha", self.login_pass)
-        btn_login = QtWidgets.QPushButton("Entrar")
-        btn_login.clicked.connect(self.do_login)
-        lv.addRow(btn_login)
-
-        # Registro
-        tab_reg = QtWidgets.QWidget()
-        tabs.addTab(tab_reg, "Registrar")
-        rv = QtWidgets.QFormLayout(tab_reg)
-        self.reg_user = QtWidgets.QLineEdit()
-        self.reg_pass1 = QtWidgets.QLineEdit()
-        self.reg_pass1.setEchoMode(QtWidgets.QLineEdit.Password)
-        self.reg_pass2 = QtWidgets.QLineEdit()
-        self.reg_pass2.setEchoMode(QtWidgets.QLineEdit.Password)
-        rv.addRow("Usuário", self.reg_user)
-        rv.addRow("Senha", self.reg_pass1)
-        rv.addRow("Repita a senha", self.reg_pass2)
-        btn_reg = QtWidgets.QPushButton("Registrar")
-        btn_reg.clicked.connect(self.do_register)
-        rv.addRow(btn_reg)
-
-    def do_login(self):
-        u = self.login_user.text().strip()
-        p = self.login_pass.text().strip()
-        if not u or not p: return
-        try:
-            r = requests.post(f"{SERVER}/login", json={"username": u, "password": p}).json()
-            if r.get("ok"):
-                self.username = u
-                save_token(u, r.get("token"))
-                self.accept()
-            else:
-                QtWidgets.QMessageBox.warning(self, "Erro", r.get("error",""))
-        except:
-            QtWidgets.QMessageBox.warning(self, "Erro", "Falha ao conectar com o servidor")
-
-    def do_register(self):
-        u = self.reg_user.text().strip()
-        p1 = self.reg_pass1.text().strip()
-        p2 = self.reg_pass2.text().strip()
-        if p1 != p2:
-            QtWidgets.QMessageBox.warning(self, "Erro", "Senhas não conferem")
-            return
-        try:
-            r = requests.post(f"{SERVER}/register", json={"username": u, "password": p1}).json()
-            if r.get("ok"):
-                QtWidgets.QMessageBox.information(self, "OK", "Registrado com sucesso")
-            else:
-                QtWidgets.QMessageBox.warning(self, "Erro", r.get("error",""))
-        except:
-            QtWidgets.QMessageBox.warning(self, "Erro", "Falha ao conectar com o servidor")
-
-# ---------------- WEBSOCKET ----------------
-class WSClient(QtCore.QThread):
-    message_received = QtCore.pyqtSignal(dict)
-
-    def __init__(self, username):
-        super().__init__()
-        self.username = username
-        self.ws = None
-
-    def run(self):
-        def on_message(ws, message):
-            try:
-                obj = json.loads(message)
-                self.message_received.emit(obj)
-            except:
-                pass
-
-        def on_open(ws):
-            print("WebSocket conectado")
-
-        def on_close(ws):
-            print("WebSocket desconectado")
-
-        self.ws = WebSocketApp(f"{WS_SERVER}/{self.username}",
-                               on_message=on_message,
-                               on_open=on_open,
-                               on_close=on_close)
-        self.ws.run_forever()
-
-    def send(self, payload: dict):
-        if self.ws and self.ws.sock and self.ws.sock.connected:
-            try:
-                self.ws.send(json.dumps(payload))
-            except:
-                pass
-
-# ---------------- CLIENT ----------------
-class RubyrubyClient(QtWidgets.QMainWindow):
-    def __init__(self, username):
-        super().__init__()
-        self.username = username
-        self.current_target = None
-        self.ws_thread = None
-        self.setWindowTitle("Rubyruby — Cliente")
-        self.resize(1000,600)
-        self.setup_ui()
-        self.start_ws()
-        self.refresh_contacts()
-        self.refresh_groups()
-
-    def setup_ui(self):
-        central = QtWidgets.QWidget()
-        self.setCentralWidget(central)
-        h = QtWidgets.QHBoxLayout(central)
-
-        # Left panel
-        left = QtWidgets.QWidget()
-        left.setFixedWidth(320)
-        lv = QtWidgets.QVBoxLayout(left)
-        self.lbl_user = QtWidgets.QLabel(f"Logado: {self.username}")
-        self.lbl_user.setStyleSheet("font-weight:bold; color:#cc3366;")
-        lv.addWidget(self.lbl_user)
-
-        tabs = QtWidgets.QTabWidget()
-        # Contatos
-        tab_contacts = QtWidgets.QWidget()
-        tc_layout = QtWidgets.QVBoxLayout(tab_contacts)
-        self.list_contacts = QtWidgets.QListWidget()
-        tc_layout.addWidget(self.list_contacts)
-        btn_add = QtWidgets.QPushButton("Adicionar contato")
-        btn_add.clicked.connect(self.add_contact)
-        tc_layout.addWidget(btn_add)
-        tabs.addTab(tab_contacts, "Contatos")
-        # Grupos
-        tab_groups = QtWidgets.QWidget()
-        tg_layout = QtWidgets.QVBoxLayout(tab_groups)
-        self.list_groups = QtWidgets.QListWidget()
-        tg_layout.addWidget(self.list_groups)
-        btn_create = QtWidgets.QPushButton("Criar grupo")
-        btn_create.clicked.connect(self.create_group)
-        btn_join = QtWidgets.QPushButton("Entrar em grupo")
-        btn_join.clicked.connect(self.join_group)
-        tg_layout.addWidget(btn_create)
-        tg_layout.addWidget(btn_join)
-        tabs.addTab(tab_groups, "Grupos")
-        lv.addWidget(tabs)
-        lv.addStretch()
-
-        self.btn_theme = QtWidgets.QPushButton("Tema: Claro")
-        self.btn_theme.setCheckable(True)
-        self.btn_theme.toggled.connect(self.toggle_theme)
-        lv.addWidget(self.btn_theme)
-        h.addWidget(left)
-
-        # Right panel
-        right = QtWidgets.QWidget()
-        rv = QtWidgets.QVBoxLayout(right)
-        self.chat_title = QtWidgets.QLabel("Conversa")
-        self.chat_title.setStyleSheet("font-weight:bold;")
-        rv.addWidget(self.chat_title)
-        self.chat_view = QtWidgets.QTextEdit()
-        self.chat_view.setReadOnly(True)
-        rv.addWidget(self.chat_view)
-        send_layout = QtWidgets.QHBoxLayout()
-        self.txt_message = QtWidgets.QLineEdit()
-        send_layout.addWidget(self.txt_message)
-        btn_send = QtWidgets.QPushButton("Enviar")
-        btn_send.clicked.connect(self.send_message)
-        send_layout.addWidget(btn_send)
-        rv.addLayout(send_layout)
-        h.addWidget(right)
-
-        # Interações
-        self.list_contacts.itemClicked.connect(self.open_contact)
-        self.list_groups.itemClicked.connect(self.open_group)
-
-    # ---------------- FUNÇÕES ----------------
-    def start_ws(self):
-        self.ws_thread = WSClient(self.username)
-        self.ws_thread.message_received.connect(self.on_ws_message)
-        self.ws_thread.start()
-
-    def on_ws_message(self, obj):
-        if obj.get("type")=="message":
-            sender = obj.get("from")
-            text = obj.get("text")
-            tgt_type = obj.get("target_type")
-            tgt = obj.get("to")
-            cur = self.current_target
-            if cur and cur.get("type")==tgt_type and str(cur.get("id"))==str(tgt):
-                self.chat_view.append(f"[{sender}] {text}")
-
-    # --- Contatos / Grupos ---
-    def refresh_contacts(self):
-        try:
-            r = requests.get(f"{SERVER}/contacts/{self.username}").json()
-            self.list_contacts.clear()
-            for c in r.get("contacts", []):
-                self.list_contacts.addItem(c)
-        except: pass
-
-    def refresh_groups(self):
-        try:
-            r = requests.get(f"{SERVER}/groups/{self.username}").json()
-            self.list_groups.clear()
-            for g in r.get("groups", []):
-                it = QtWidgets.QListWidgetItem(f"{g['name']} (id:{g['id']})")
-                it.setData(QtCore.Qt.UserRole, g)
-                self.list_groups.addItem(it)
-        except: pass
-
-    def add_contact(self):
-        text, ok = QtWidgets.QInputDialog.getText(self, "Adicionar Contato", "Usuário:")
-        if ok and text:
-            requests.post(f"{SERVER}/add_contact", json={"owner":self.username,"contact":text})
-            self.refresh_contacts()
-
-    def create_group(self):
-        text, ok = QtWidgets.QInputDialog.getText(self, "Criar Grupo", "Nome do grupo:")
-        if ok and text:
-            requests.post(f"{SERVER}/create_group", json={"owner":self.username,"name":text})
-            self.refresh_groups()
-
-    def join_group(self):
-        gid, ok = QtWidgets.QInputDialog.getInt(self, "Entrar em Grupo", "ID do grupo:")
-        if ok:
-            requests.post(f"{SERVER}/join_group", json={"user":self.username,"group_id":gid})
-            self.refresh_groups()
-
-    # --- Abrir conversa ---
-    def open_contact(self, item):
-        contact = item.text()
-        self.current_target = {"type":"user","id":contact}
-        self.chat_title.setText(f"Conversa com {contact}")
-        try:
-            r = requests.get(f"{SERVER}/messages/{self.username}/user/{contact}").json()
-            self.chat_view.clear()
-            for m in r.get("messages", []):
-                self.chat_view.append(f"[{m['sender']}] {m['text']}")
-        except: pass
-
-    def open_group(self, item):
-        g = item.data(QtCore.Qt.UserRole)
-        self.current_target = {"type":"group","id":g['id']}
-        self.chat_title.setText(f"Grupo: {g['name']}")
-        try:
-            r = requests.get(f"{SERVER}/messages/{self.username}/group/{g['id']}").json()
-            self.chat_view.clear()
-            for m in r.get("messages", []):
-                self.chat_view.append(f"[{m['sender']}] {m['text']}")
-        except: pass
-
-    # --- Enviar mensagem ---
-    def send_message(self):
-        text = self.txt_message.text().strip()
-        if not text or not self.current_target: return
-        payload = {"type":"message","target_type":self.current_target["type"],"target":self.current_target["id"],"text":text}
-        if self.ws_thread:
-            self.ws_thread.send(payload)
-        self.chat_view.append(f"[{self.username}] {text}")
-        self.txt_message.clear()
-
-    # --- Tema ---
-    def toggle_theme(self, on):
-        if on:
-            self.setStyleSheet("QWidget {background:#222;color:#ddd} QPushButton{background:#444;color:#fff}")
-            self.btn_theme.setText("Tema: Escuro")
-        else:
-            self.setStyleSheet("")
-            self.btn_theme.setText("Tema: Claro")
-
-# ---------------- MAIN ----------------
-if __name__=="__main__":
-    app = QtWidgets.QApplication(sys.argv)
-    username, token = load_token()
-    if not username:
-        dlg = LoginDialog()
-        if dlg.exec_() == QtWidgets.QDialog.Accepted:
-            username = dlg.username
-        else:
-            sys.exit(0)
-    w = RubyrubyClient(username)
-    w.show()
-    sys.exit(app.exec_())
+# rubyruby_client_render.py
+import sys, os, json, math, random, time
+from PyQt5 import QtWidgets, QtCore
+from websocket import ABNF, WebSocketApp
+import threading
+from client_store import LocalStore
+from client_net import Api, Net
+from client_view import ChatView
+from protocol import PROTOCOL, decode_frame, encode_frame, encode_record
+
+SERVER = "https://rubyruby-server.onrender.com"
+WS_SERVER = "wss://rubyruby-server.onrender.com/ws"
+TOKEN_FILE = "user_token.json"
+PAGE_SIZE = 50
+RECONNECT_MIN = 1    # segundos até a primeira tentativa de reconexão
+RECONNECT_MAX = 60   # a espera dobra a cada falha até este teto
+MAX_CATCHUP_PAGES = 20  # acima disso a conversa em cache é descartada e recarregada
+TYPING_EVERY = 3     # segundos entre avisos de "digitando" enquanto se digita
+
+# ---------------- TOKEN ----------------
+def load_token():
+    if os.path.exists(TOKEN_FILE):
+        try:
+            with open(TOKEN_FILE, "r") as f:
+                data = json.load(f)
+                return data.get("username"), data.get("token")
+        except:
+            return None, None
+    return None, None
+
+def save_token(username, token):
+    with open(TOKEN_FILE, "w") as f:
+        json.dump({"username": username, "token": token}, f)
+
+# ---------------- LOGIN DIALOG ----------------
+class LoginDialog(QtWidgets.QDialog):
+    def __init__(self, net):
+        super().__init__()
+        self.setWindowTitle("Rubyruby — Login / Registro")
+        self.net = net
+        self.username = None
+        layout = QtWidgets.QVBoxLayout(self)
+
+        tabs = QtWidgets.QTabWidget()
+        layout.addWidget(tabs)
+
+        # Login
+        tab_login = QtWidgets.QWidget()
+        tabs.addTab(tab_login, "Login")
+        lv = QtWidgets.QFormLayout(tab_login)
+        self.login_user = QtWidgets.QLineEdit()
+        self.login_pass = QtWidgets.QLineEdit()
+        self.login_pass.setEchoMode(QtWidgets.QLineEdit.Password)
+        lv.addRow("Usuário", self.login_user)
+        lv.addRow("Senha", self.login_pass)
+        btn_login = QtWidgets.QPushButton("Entrar")
+        btn_login.clicked.connect(self.do_login)
+        lv.addRow(btn_login)
+
+        # Registro
+        tab_reg = QtWidgets.QWidget()
+        tabs.addTab(tab_reg, "Registrar")
+        rv = QtWidgets.QFormLayout(tab_reg)
+        self.reg_user = QtWidgets.QLineEdit()
+        self.reg_pass1 = QtWidgets.QLineEdit()
+        self.reg_pass1.setEchoMode(QtWidgets.QLineEdit.Password)
+        self.reg_pass2 = QtWidgets.QLineEdit()
+        self.reg_pass2.setEchoMode(QtWidgets.QLineEdit.Password)
+        rv.addRow("Usuário", self.reg_user)
+        rv.addRow("Senha", self.reg_pass1)
+        rv.addRow("Repita a senha", self.reg_pass2)
+        btn_reg = QtWidgets.QPushButton("Registrar")
+        btn_reg.clicked.connect(self.do_register)
+        rv.addRow(btn_reg)
+
+    def do_login(self):
+        u = self.login_user.text().strip()
+        p = self.login_pass.text().strip()
+        if not u or not p: return
+        self.net.post("/login", json={"username": u, "password": p}, key="login",
+                      callback=lambda r: self.on_login(u, r), errback=self.on_net_error)
+
+    def on_login(self, u, r):
+        if r.get("ok"):
+            self.username = u
+            save_token(u, r.get("token"))
+            self.accept()
+        else:
+            QtWidgets.QMessageBox.warning(self, "Erro", r.get("error",""))
+
+    def do_register(self):
+        u = self.reg_user.text().strip()
+        p1 = self.reg_pass1.text().strip()
+        p2 = self.reg_pass2.text().strip()
+        if p1 != p2:
+            QtWidgets.QMessageBox.warning(self, "Erro", "Senhas não conferem")
+            return
+        self.net.post("/register", json={"username": u, "password": p1}, key="register",
+                      callback=self.on_register, errback=self.on_net_error)
+
+    def on_register(self, r):
+        if r.get("ok"):
+            QtWidgets.QMessageBox.information(self, "OK", "Registrado com sucesso")
+        else:
+            QtWidgets.QMessageBox.warning(self, "Erro", r.get("error",""))
+
+    def on_net_error(self, error):
+        QtWidgets.QMessageBox.warning(self, "Erro", "Falha ao conectar com o servidor")
+
+# ---------------- WEBSOCKET ----------------
+class WSClient(QtCore.QThread):
+    message_received = QtCore.pyqtSignal(dict)
+    auth_failed = QtCore.pyqtSignal()
+
+    def __init__(self, username, token, last_id=None):
+        super().__init__()
+        self.username = username
+        self.token = token
+        self.ws = None
+        self.binary = False  # protocolo binário aceito pelo servidor nesta conexão
+        self.offer_binary = True
+        self.running = True
+        self.wake = threading.Event()  # interrompe a espera entre reconexões
+        self.delay = RECONNECT_MIN
+        self.last_id = last_id  # maior id recebido; retoma a partir dele ao reconectar
+
+    def run(self):
+        def on_message(ws, message):
+            try:
+                # Frame binário pode trazer várias mensagens de uma vez.
+                objs = decode_frame(message) if isinstance(message, bytes) else [json.loads(message)]
+            except:
+                return
+            for obj in objs:
+                msgs = obj.get("messages", []) if obj.get("type")=="backlog" else [obj]
+                for m in msgs:
+                    if m.get("type")=="message" and m.get("id") is not None:
+                        self.last_id = max(self.last_id or 0, m["id"])
+                self.message_received.emit(obj)
+
+        def on_open(ws):
+            self.binary = ws.sock.getsubprotocol() == PROTOCOL
+            self.delay = RECONNECT_MIN
+            print("WebSocket conectado" + (" (binário)" if self.binary else ""))
+
+        def on_close(ws, *args):
+            print("WebSocket desconectado")
+
+        def on_error(ws, error):
+            # 403 no handshake: sessão expirada ou revogada, não adianta reconectar.
+            if getattr(error, "status_code", None) == 403:
+                self.running = False
+                self.auth_failed.emit()
+            elif self.offer_binary and "Invalid WebSocket Header" in str(error):
+                # Servidor antigo recusou o subprotocolo: volta ao JSON.
+                self.offer_binary = False
+
+        while self.running:
+            url = f"{WS_SERVER}/{self.token}"
+            if self.last_id is not None:
+                url += f"?since={self.last_id}"
+            self.ws = WebSocketApp(url,
+                                   subprotocols=[PROTOCOL] if self.offer_binary else None,
+                                   on_message=on_message,
+                                   on_open=on_open,
+                                   on_close=on_close,
+                                   on_error=on_error)
+            self.ws.run_forever()
+            if self.running:
+                # Espera exponencial com jitter: depois de uma queda do
+                # servidor os clientes não voltam todos no mesmo instante.
+                self.wake.wait(random.uniform(self.delay / 2, self.delay))
+                self.delay = min(self.delay * 2, RECONNECT_MAX)
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.ws:
+            self.ws.close()
+
+    def send(self, payload: dict):
+        if self.ws and self.ws.sock and self.ws.sock.connected:
+            try:
+                if self.binary:
+                    self.ws.send(encode_frame([encode_record(payload)]), ABNF.OPCODE_BINARY)
+                else:
+                    self.ws.send(json.dumps(payload))
+            except:
+                pass
+
+# ---------------- CLIENT ----------------
+class RubyrubyClient(QtWidgets.QMainWindow):
+    def __init__(self, username, token, net):
+        super().__init__()
+        self.username = username
+        self.token = token
+        self.net = net
+        self.net.api.set_token(token)
+        self.net.auth_failed.connect(self.on_auth_failed)
+        self.signed_out = False
+        self.current_target = None
+        self.sent_ids = set()
+        self.pending = {}  # ref -> (conversa, texto) aguardando ack
+        self.next_ref = 0
+        self.ws_thread = None
+        self.online = set()   # contatos e membros de grupos online
+        self.typing = set()   # (usuário, conversa) digitando agora
+        self.typing_sent = (None, 0)   # conversa e instante do último aviso enviado
+        self.store = LocalStore.for_user(username, TOKEN_FILE)
+        self.setWindowTitle("Rubyruby — Cliente")
+        self.resize(1000,600)
+        self.setup_ui()
+        # Mostra o que está no cache antes de qualquer acesso à rede.
+        self.show_contacts(self.store.contacts())
+        self.show_groups(self.store.groups())
+        self.start_ws()
+        self.refresh_contacts()
+        self.refresh_groups()
+
+    def setup_ui(self):
+        central = QtWidgets.QWidget()
+        self.setCentralWidget(central)
+        h = QtWidgets.QHBoxLayout(central)
+
+        # Left panel
+        left = QtWidgets.QWidget()
+        left.setFixedWidth(320)
+        lv = QtWidgets.QVBoxLayout(left)
+        self.lbl_user = QtWidgets.QLabel(f"Logado: {self.username}")
+        self.lbl_user.setStyleSheet("font-weight:bold; color:#cc3366;")
+        lv.addWidget(self.lbl_user)
+
+        tabs = QtWidgets.QTabWidget()
+        # Contatos
+        tab_contacts = QtWidgets.QWidget()
+        tc_layout = QtWidgets.QVBoxLayout(tab_contacts)
+        self.list_contacts = QtWidgets.QListWidget()
+        tc_layout.addWidget(self.list_contacts)
+        btn_add = QtWidgets.QPushButton("Adicionar contato")
+        btn_add.clicked.connect(self.add_contact)
+        tc_layout.addWidget(btn_add)
+        tabs.addTab(tab_contacts, "Contatos")
+        # Grupos
+        tab_groups = QtWidgets.QWidget()
+        tg_layout = QtWidgets.QVBoxLayout(tab_groups)
+        self.list_groups = QtWidgets.QListWidget()
+        tg_layout.addWidget(self.list_groups)
+        btn_create = QtWidgets.QPushButton("Criar grupo")
+        btn_create.clicked.connect(self.create_group)
+        btn_join = QtWidgets.QPushButton("Entrar em grupo")
+        btn_join.clicked.connect(self.join_group)
+        tg_layout.addWidget(btn_create)
+        tg_layout.addWidget(btn_join)
+        tabs.addTab(tab_groups, "Grupos")
+        lv.addWidget(tabs)
+        lv.addStretch()
+
+        self.btn_theme = QtWidgets.QPushButton("Tema: Claro")
+        self.btn_theme.setCheckable(True)
+        self.btn_theme.toggled.connect(self.toggle_theme)
+        lv.addWidget(self.btn_theme)
+        h.addWidget(left)
+
+        # Right panel
+        right = QtWidgets.QWidget()
+        rv = QtWidgets.QVBoxLayout(right)
+        self.chat_title = QtWidgets.QLabel("Conversa")
+        self.chat_title.setStyleSheet("font-weight:bold;")
+        rv.addWidget(self.chat_title)
+        self.chat_view = ChatView()
+        rv.addWidget(self.chat_view)
+        self.lbl_typing = QtWidgets.QLabel("")
+        self.lbl_typing.setStyleSheet("color:#888; font-style:italic;")
+        rv.addWidget(self.lbl_typing)
+        send_layout = QtWidgets.QHBoxLayout()
+        self.txt_message = QtWidgets.QLineEdit()
+        send_layout.addWidget(self.txt_message)
+        btn_send = QtWidgets.QPushButton("Enviar")
+        btn_send.clicked.connect(self.send_message)
+        send_layout.addWidget(btn_send)
+        rv.addLayout(send_layout)
+        h.addWidget(right)
+
+        # Interações
+        self.list_contacts.itemClicked.connect(self.open_contact)
+        self.list_groups.itemClicked.connect(self.open_group)
+        self.txt_message.textEdited.connect(self.on_text_edited)
+        self.chat_view.reached_top.connect(self.on_chat_top)
+        self.chat_view.reached_bottom.connect(self.load_newer)
+
+    # ---------------- FUNÇÕES ----------------
+    def start_ws(self):
+        self.ws_thread = WSClient(self.username, self.token, self.store.meta("last_id"))
+        self.ws_thread.message_received.connect(self.on_ws_message)
+        self.ws_thread.auth_failed.connect(self.on_auth_failed)
+        self.ws_thread.start()
+
+    def on_auth_failed(self):
+        # Chega pelo WebSocket e por cada pedido HTTP recusado: avisa uma vez só.
+        if self.signed_out:
+            return
+        self.signed_out = True
+        if os.path.exists(TOKEN_FILE):
+            os.remove(TOKEN_FILE)
+        QtWidgets.QMessageBox.warning(self, "Sessão expirada", "Sua sessão expirou. Entre novamente.")
+        self.close()
+
+    def on_ws_message(self, obj):
+        t = obj.get("type")
+        if t in ("dropped","resync"):
+            # O servidor descartou mensagens do stream: o cache pode ter lacunas.
+            self.store.mark_all_stale()
+            if self.current_target:
+                self.load_history()
+            return
+        if t=="ack":
+            self.sent_ids.add(obj.get("id"))
+            p = self.pending.pop(obj.get("ref"), None)
+            if p:
+                self.store.apply_stream_message(p[0], {"id": obj["id"], "sender": self.username, "text": p[1]})
+                self.store.commit()
+                if p[0] == self.current_conv():
+                    self.chat_view.confirm(obj["id"])
+            return
+        if t in ("throttled", "error"):
+            # Recusada pelo servidor (limite de envio ou erro): não foi gravada.
+            p = self.pending.pop(obj.get("ref"), None)
+            if p:
+                if p[0] == self.current_conv():
+                    self.chat_view.discard_pending()
+                if not self.txt_message.text():
+                    self.txt_message.setText(p[1])
+            if t=="error":
+                self.statusBar().showMessage(f"Mensagem não enviada: {obj.get('error')}", 5000)
+                return
+            wait = max(1, math.ceil(obj.get("retry_after") or 1))
+            self.statusBar().showMessage(f"Mensagem não enviada: limite de envio atingido. Tente de novo em {wait} s.", 5000)
+            return
+        if t=="presence":
+            self.apply_presence(obj)
+            return
+        if t=="backlog":
+            for m in obj.get("messages", []):
+                self.handle_message(m)
+            self.store.commit()
+        elif t=="message":
+            self.handle_message(obj)
+            self.store.commit()
+
+    def handle_message(self, obj):
+        sender = obj.get("from")
+        text = obj.get("text")
+        tgt_type = obj.get("target_type")
+        tgt = obj.get("to")
+        if tgt_type=="user" and tgt==self.username:
+            tgt = sender  # DM recebida: a conversa é com o remetente
+        conv = f"{tgt_type}:{tgt}"
+        self.store.apply_stream_message(conv, {"id": obj["id"], "sender": sender, "text": text, "ts": obj.get("ts")})
+        if obj["id"] > (self.store.meta("last_id") or 0):
+            self.store.set_meta("last_id", obj["id"])
+        if obj.get("id") in self.sent_ids:
+            return  # eco de uma mensagem nossa, já exibida ao enviar
+        if conv == self.current_conv():
+            self.chat_view.append_live({"id": obj["id"], "sender": sender, "text": text})
+
+    # --- Presença ---
+    def apply_presence(self, obj):
+        # O servidor manda um retrato completo ao conectar e depois só
+        # diferenças, agrupadas a cada segundo.
+        if obj.get("snapshot"):
+            self.online = set(obj.get("online", []))
+            self.typing = set()
+        else:
+            self.online |= set(obj.get("online", []))
+            self.online -= set(obj.get("offline", []))
+        for user, tgt_type, tgt in obj.get("typing", []):
+            self.typing.add((user, self.typing_conv(user, tgt_type, tgt)))
+        for user, tgt_type, tgt in obj.get("stopped", []):
+            self.typing.discard((user, self.typing_conv(user, tgt_type, tgt)))
+        self.show_contacts(self.store.contacts())
+        self.show_typing()
+
+    def typing_conv(self, user, tgt_type, tgt):
+        return f"user:{user}" if tgt_type=="user" else f"{tgt_type}:{tgt}"
+
+    def show_typing(self):
+        conv = self.current_conv()
+        names = sorted(u for u, c in self.typing if c == conv)
+        if not names:
+            self.lbl_typing.setText("")
+        elif len(names) == 1:
+            self.lbl_typing.setText(f"{names[0]} está digitando…")
+        else:
+            self.lbl_typing.setText(f"{', '.join(names)} estão digitando…")
+
+    def on_text_edited(self, text):
+        if not self.current_target or not self.ws_thread:
+            return
+        conv, sent_at = self.typing_sent
+        typing = {"type":"typing","target_type":self.current_target["type"],"target":self.current_target["id"]}
+        if text.strip():
+            if conv != self.current_conv() or time.monotonic() - sent_at >= TYPING_EVERY:
+                self.ws_thread.send(typing)
+                self.typing_sent = (self.current_conv(), time.monotonic())
+        elif conv == self.current_conv():
+            self.ws_thread.send({**typing, "active": False})
+            self.typing_sent = (None, 0)
+
+    # --- Contatos / Grupos ---
+    def show_contacts(self, contacts):
+        self.list_contacts.clear()
+        for c in contacts:
+            it = QtWidgets.QListWidgetItem(f"● {c}" if c in self.online else c)
+            it.setData(QtCore.Qt.UserRole, c)
+            self.list_contacts.addItem(it)
+
+    def show_groups(self, groups):
+        self.list_groups.clear()
+        for g in groups:
+            it = QtWidgets.QListWidgetItem(f"{g['name']} (id:{g['id']})")
+            it.setData(QtCore.Qt.UserRole, g)
+            self.list_groups.addItem(it)
+
+    def refresh_contacts(self):
+        self.net.get(f"/contacts/{self.username}", key="contacts", callback=self.on_contacts)
+
+    def on_contacts(self, r):
+        contacts = r.get("contacts", [])
+        if contacts != self.store.contacts():
+            self.store.save_contacts(contacts)
+            self.show_contacts(contacts)
+
+    def refresh_groups(self):
+        self.net.get(f"/groups/{self.username}", key="groups", callback=self.on_groups)
+
+    def on_groups(self, r):
+        groups = r.get("groups", [])
+        if groups != self.store.groups():
+            self.store.save_groups(groups)
+            self.show_groups(groups)
+
+    def add_contact(self):
+        text, ok = QtWidgets.QInputDialog.getText(self, "Adicionar Contato", "Usuário:")
+        if ok and text:
+            self.net.post("/add_contact", json={"owner":self.username,"contact":text},
+                          callback=lambda r: self.refresh_contacts())
+
+    def create_group(self):
+        text, ok = QtWidgets.QInputDialog.getText(self, "Criar Grupo", "Nome do grupo:")
+        if ok and text:
+            self.net.post("/create_group", json={"owner":self.username,"name":text},
+                          callback=lambda r: self.refresh_groups())
+
+    def join_group(self):
+        gid, ok = QtWidgets.QInputDialog.getInt(self, "Entrar em Grupo", "ID do grupo:")
+        if ok:
+            self.net.post("/join_group", json={"user":self.username,"group_id":gid},
+                          callback=lambda r: self.refresh_groups())
+
+    # --- Abrir conversa ---
+    def open_contact(self, item):
+        contact = item.data(QtCore.Qt.UserRole)
+        self.current_target = {"type":"user","id":contact}
+        self.chat_title.setText(f"Conversa com {contact}")
+        self.show_typing()
+        self.load_history()
+
+    def open_group(self, item):
+        g = item.data(QtCore.Qt.UserRole)
+        self.current_target = {"type":"group","id":g['id']}
+        self.chat_title.setText(f"Grupo: {g['name']}")
+        self.show_typing()
+        self.load_history()
+
+    # --- Histórico (cache local + rede) ---
+    def current_conv(self):
+        t = self.current_target
+        return f"{t['type']}:{t['id']}" if t else None
+
+    def fetch_page(self, target, callback, errback=None, key="history", before_id=None, after_id=None):
+        # Todos os pedidos de histórico da conversa aberta usam a mesma chave:
+        # ao trocar de conversa, os da anterior são descartados.
+        params = {"limit": PAGE_SIZE}
+        if before_id is not None:
+            params["before_id"] = before_id
+        if after_id is not None:
+            params["after_id"] = after_id
+        self.net.get(f"/messages/{self.username}/{target['type']}/{target['id']}", params=params, key=key,
+                     callback=callback, errback=errback)
+
+    def render_cached(self):
+        msgs = self.store.messages(self.current_conv(), limit=PAGE_SIZE)
+        self.chat_view.set_messages(msgs)
+        return len(msgs)
+
+    def load_history(self):
+        # Desenha do cache na hora; depois busca só o que falta no servidor.
+        target, conv = self.current_target, self.current_conv()
+        self.net.cancel("older")
+        self.render_cached()
+        state = self.store.sync_state(conv)
+        ws_live = self.ws_thread and self.ws_thread.ws and self.ws_thread.ws.sock and self.ws_thread.ws.sock.connected
+        if state and not state["stale"] and ws_live:
+            self.history_synced(conv, False)  # o stream do WebSocket já mantém esta conversa em dia
+        elif state:
+            self.catch_up(target, conv, state["synced_id"], 0)
+        else:
+            self.fetch_latest(target, conv)
+
+    def catch_up(self, target, conv, after, pages):
+        # Traz apenas o que é mais novo que o cache, uma página por pedido.
+        if pages >= MAX_CATCHUP_PAGES:
+            # Atraso grande demais: recomeça a conversa pela página mais recente.
+            self.store.clear_conversation(conv)
+            self.fetch_latest(target, conv)
+            return
+        def on_page(r):
+            msgs = r.get("messages", [])
+            self.store.add_messages(conv, msgs)
+            last = msgs[-1]["id"] if msgs else after
+            self.store.set_synced(conv, last)
+            if r.get("next_cursor") is None:
+                self.store.commit()
+                self.history_synced(conv, pages > 0 or bool(msgs))
+            else:
+                self.catch_up(target, conv, last, pages + 1)
+        self.fetch_page(target, on_page, errback=lambda e: self.history_synced(conv, False), after_id=after)
+
+    def fetch_latest(self, target, conv):
+        def on_page(r):
+            msgs = r.get("messages", [])
+            self.store.add_messages(conv, msgs)
+            self.store.set_synced(conv, msgs[-1]["id"] if msgs else 0)
+            if r.get("next_cursor") is None:
+                self.store.set_complete(conv)
+            self.store.commit()
+            self.history_synced(conv, True)
+        self.fetch_page(target, on_page, errback=lambda e: self.history_synced(conv, False))
+
+    def history_synced(self, conv, changed):
+        if conv != self.current_conv():
+            return
+        shown = self.render_cached() if changed else self.chat_view.count()
+        state = self.store.sync_state(conv)
+        if shown < PAGE_SIZE and state and not state["complete"]:
+            self.load_older()
+
+    def on_chat_top(self):
+        if self.current_target and self.chat_view.first_id() is not None:
+            self.load_older()
+
+    def load_older(self):
+        conv = self.current_conv()
+        before = self.chat_view.first_id()
+        msgs = self.store.messages(conv, before_id=before, limit=PAGE_SIZE)
+        state = self.store.sync_state(conv)
+        if len(msgs) < PAGE_SIZE and state and not state["complete"]:
+            def on_page(r):
+                self.store.add_messages(conv, r.get("messages", []))
+                if r.get("next_cursor") is None:
+                    self.store.set_complete(conv)
+                self.store.commit()
+                self.show_older(conv, before)
+            self.fetch_page(self.current_target, on_page, errback=lambda e: self.show_older(conv, before),
+                            key="older", before_id=self.store.oldest_id(conv))
+            return
+        self.show_older(conv, before, msgs)
+
+    def show_older(self, conv, before, msgs=None):
+        if conv != self.current_conv() or before != self.chat_view.first_id():
+            return  # a tela mudou enquanto a página vinha do servidor
+        if msgs is None:
+            msgs = self.store.messages(conv, before_id=before, limit=PAGE_SIZE)
+        if not msgs:
+            return
+        if before is None:
+            self.render_cached()
+            return
+        self.chat_view.prepend(msgs)
+
+    def load_newer(self):
+        # A lista soltou as mensagens mais novas ao subir; voltam do cache.
+        conv = self.current_conv()
+        after = self.chat_view.last_id()
+        if conv is None or after is None:
+            return
+        msgs = self.store.newer_messages(conv, after, limit=PAGE_SIZE)
+        self.chat_view.append_page(msgs, has_newer=len(msgs) == PAGE_SIZE)
+
+    # --- Enviar mensagem ---
+    def send_message(self):
+        text = self.txt_message.text().strip()
+        if not text or not self.current_target: return
+        self.next_ref += 1
+        payload = {"type":"message","target_type":self.current_target["type"],"target":self.current_target["id"],"text":text,"ref":self.next_ref}
+        self.pending[self.next_ref] = (self.current_conv(), text)
+        if self.ws_thread:
+            self.ws_thread.send(payload)
+        self.chat_view.append_live({"id": None, "sender": self.username, "text": text})
+        self.txt_message.clear()
+        self.typing_sent = (None, 0)   # o servidor encerra o "digitando" ao receber a mensagem
+
+    def closeEvent(self, event):
+        self.net.cancel_all()
+        if self.ws_thread:
+            self.ws_thread.stop()
+            self.ws_thread.wait(2000)
+        super().closeEvent(event)
+
+    # --- Tema ---
+    def toggle_theme(self, on):
+        if on:
+            self.setStyleSheet("QWidget {background:#222;color:#ddd} QPushButton{background:#444;color:#fff}")
+            self.btn_theme.setText("Tema: Escuro")
+        else:
+            self.setStyleSheet("")
+            self.btn_theme.setText("Tema: Claro")
+
+# ---------------- MAIN ----------------
+if __name__=="__main__":
+    app = QtWidgets.QApplication(sys.argv)
+    net = Net(Api(SERVER))
+    username, token = load_token()
+    if not username or not token or token == username:  # token antigo era o próprio usuário
+        dlg = LoginDialog(net)
+        if dlg.exec_() == QtWidgets.QDialog.Accepted:
+            username, token = load_token()
+        else:
+            sys.exit(0)
+    w = RubyrubyClient(username, token, net)
+    w.show()
+    sys.exit(app.exec_())
@@ -0,0 +1,114 @@
+# client_net.py
+# Rede HTTP do cliente, fora da thread da interface.
+#
+# Api mantém uma única requests.Session com keep-alive: todos os pedidos
+# reaproveitam as mesmas conexões TLS em vez de abrir uma nova a cada
+# chamada. Net roda os pedidos num QThreadPool e entrega o resultado pelo
+# sinal finished, que o Qt enfileira para a thread da interface; os
+# callbacks rodam lá e podem mexer nos widgets e no LocalStore.
+#
+# Respostas fora de 2xx viram erro e vão para o errback; um 401 (sessão
+# expirada ou revogada) também dispara o sinal auth_failed.
+#
+# Pedidos com a mesma chave se substituem: ao trocar de conversa ou ao
+# atualizar várias vezes seguidas, o pedido anterior que ainda está na
+# fila nem chega a sair, e o resultado de um que já estava em voo é
+# descartado.
+
+import functools
+import requests
+from requests.adapters import HTTPAdapter
+from PyQt5 import QtCore
+
+WORKERS = 4    # pedidos simultâneos
+TIMEOUT = 15   # segundos
+
+class Api:
+    def __init__(self, base, workers=WORKERS):
+        self.base = base
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def set_token(self, token):
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def request(self, method, path, **kw):
+        r = self.session.request(method, self.base + path, timeout=TIMEOUT, **kw)
+        r.raise_for_status()
+        return r.json()
+
+class Job(QtCore.QRunnable):
+    def __init__(self, net, ticket, key, fn):
+        super().__init__()
+        self.net = net
+        self.ticket = ticket
+        self.key = key
+        self.fn = fn
+
+    def run(self):
+        if self.key is not None and self.net.latest.get(self.key) != self.ticket:
+            result, error = None, None   # já substituído enquanto esperava na fila
+        else:
+            try:
+                result, error = self.fn(), None
+            except Exception as e:
+                result, error = None, e
+        self.net.finished.emit(self.ticket, result, error)
+
+class Net(QtCore.QObject):
+    finished = QtCore.pyqtSignal(int, object, object)   # ticket, resultado, erro
+    auth_failed = QtCore.pyqtSignal()
+
+    def __init__(self, api, workers=WORKERS):
+        super().__init__()
+        self.api = api
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(workers)
+        self.next_ticket = 0
+        self.callbacks = {}   # ticket -> (chave, callback, errback)
+        self.latest = {}      # chave -> ticket do pedido mais recente
+        self.finished.connect(self.on_finished)
+
+    def submit(self, fn, *args, key=None, callback=None, errback=None, **kw):
+        """Roda fn(*args, **kw) no pool; callback(resultado) ou errback(erro)
+        é chamado na thread da interface."""
+        self.next_ticket += 1
+        ticket = self.next_ticket
+        if key is not None:
+            self.latest[key] = ticket
+        self.callbacks[ticket] = (key, callback, errback)
+        self.pool.start(Job(self, ticket, key, functools.partial(fn, *args, **kw)))
+        return ticket
+
+    def get(self, path, **kw):
+        return self.submit(self.api.request, "GET", path, **kw)
+
+    def post(self, path, **kw):
+        return self.submit(self.api.request, "POST", path, **kw)
+
+    def cancel(self, key):
+        self.latest.pop(key, None)
+
+    def cancel_all(self):
+        self.latest.clear()
+        self.callbacks.clear()
+        self.pool.clear()
+
+    def on_finished(self, ticket, result, error):
+        entry = self.callbacks.pop(ticket, None)
+        if entry is None:
+            return
+        if getattr(getattr(error, "response", None), "status_code", None) == 401:
+            self.auth_failed.emit()
+        key, callback, errback = entry
+        if key is not None:
+            if self.latest.get(key) != ticket:
+                return   # superado por um pedido mais novo com a mesma chave
+            del self.latest[key]
+        if error is None:
+            if callback:
+                callback(result)
+        elif errback:
+            errback(error)
@@ -0,0 +1,133 @@
+# client_store.py
+# Cache local do cliente: mensagens, contatos e grupos em SQLite, ao lado de
+# user_token.json. A conversa aberta é desenhada a partir daqui e a rede só
+# busca o que ainda não está no cache.
+#
+# Cada conversa guarda em sync_state até que id o cache está completo
+# (synced_id), se já tem o início do histórico (complete) e se pode ter
+# lacunas (stale) porque o servidor descartou mensagens do stream.
+
+import os
+import sqlite3
+
+class LocalStore:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        c = self.conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                conv TEXT,
+                sender TEXT,
+                text TEXT,
+                ts TEXT
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv ON messages(conv, id)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                conv TEXT PRIMARY KEY,
+                synced_id INTEGER,
+                complete INTEGER DEFAULT 0,
+                stale INTEGER DEFAULT 0
+            )
+        """)
+        c.execute("CREATE TABLE IF NOT EXISTS contacts (name TEXT PRIMARY KEY)")
+        c.execute("CREATE TABLE IF NOT EXISTS groups (id INTEGER PRIMARY KEY, name TEXT)")
+        c.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.conn.commit()
+
+    @staticmethod
+    def for_user(username, token_file):
+        folder = os.path.dirname(os.path.abspath(token_file))
+        return LocalStore(os.path.join(folder, f"cache_{username}.db"))
+
+    def commit(self):
+        self.conn.commit()
+
+    # --- Contatos / Grupos ---
+    def contacts(self):
+        return [r[0] for r in self.conn.execute("SELECT name FROM contacts ORDER BY name")]
+
+    def save_contacts(self, names):
+        self.conn.execute("DELETE FROM contacts")
+        self.conn.executemany("INSERT OR IGNORE INTO contacts (name) VALUES (?)", [(n,) for n in names])
+        self.conn.commit()
+
+    def groups(self):
+        return [{"id": r[0], "name": r[1]} for r in self.conn.execute("SELECT id, name FROM groups ORDER BY id")]
+
+    def save_groups(self, groups):
+        self.conn.execute("DELETE FROM groups")
+        self.conn.executemany("INSERT OR REPLACE INTO groups (id, name) VALUES (?, ?)",
+                              [(g["id"], g["name"]) for g in groups])
+        self.conn.commit()
+
+    # --- Mensagens ---
+    def add_messages(self, conv, msgs):
+        self.conn.executemany("INSERT OR IGNORE INTO messages (id, conv, sender, text, ts) VALUES (?, ?, ?, ?, ?)",
+                              [(m["id"], conv, m["sender"], m["text"], m.get("ts")) for m in msgs])
+
+    def messages(self, conv, before_id=None, limit=50):
+        # As `limit` mensagens mais recentes antes de before_id, em ordem crescente.
+        rows = self.conn.execute("""
+            SELECT id, sender, text, ts FROM messages
+            WHERE conv=? AND id<?
+            ORDER BY id DESC LIMIT ?
+        """, (conv, before_id if before_id is not None else 2**63 - 1, limit)).fetchall()
+        return [{"id": r[0], "sender": r[1], "text": r[2], "ts": r[3]} for r in reversed(rows)]
+
+    def newer_messages(self, conv, after_id, limit=50):
+        # As `limit` mensagens seguintes a after_id, em ordem crescente.
+        rows = self.conn.execute("""
+            SELECT id, sender, text, ts FROM messages
+            WHERE conv=? AND id>?
+            ORDER BY id LIMIT ?
+        """, (conv, after_id, limit)).fetchall()
+        return [{"id": r[0], "sender": r[1], "text": r[2], "ts": r[3]} for r in rows]
+
+    def oldest_id(self, conv):
+        return self.conn.execute("SELECT min(id) FROM messages WHERE conv=?", (conv,)).fetchone()[0]
+
+    def clear_conversation(self, conv):
+        self.conn.execute("DELETE FROM messages WHERE conv=?", (conv,))
+        self.conn.execute("DELETE FROM sync_state WHERE conv=?", (conv,))
+
+    # --- Estado de sincronização ---
+    def sync_state(self, conv):
+        row = self.conn.execute("SELECT synced_id, complete, stale FROM sync_state WHERE conv=?", (conv,)).fetchone()
+        if not row:
+            return None
+        return {"synced_id": row[0], "complete": bool(row[1]), "stale": bool(row[2])}
+
+    def set_synced(self, conv, synced_id):
+        self.conn.execute("""
+            INSERT INTO sync_state (conv, synced_id) VALUES (?, ?)
+            ON CONFLICT(conv) DO UPDATE SET synced_id=max(synced_id, excluded.synced_id), stale=0
+        """, (conv, synced_id))
+
+    def set_complete(self, conv):
+        self.conn.execute("UPDATE sync_state SET complete=1 WHERE conv=?", (conv,))
+
+    def mark_all_stale(self):
+        self.conn.execute("UPDATE sync_state SET stale=1")
+        self.conn.commit()
+
+    def apply_stream_message(self, conv, msg):
+        # Mensagens do WebSocket chegam em ordem e sem lacunas enquanto o
+        # stream não for interrompido, então avançam synced_id da conversa.
+        self.add_messages(conv, [msg])
+        state = self.sync_state(conv)
+        if state is None:
+            self.set_synced(conv, msg["id"])
+        elif not state["stale"]:
+            self.conn.execute("UPDATE sync_state SET synced_id=max(synced_id, ?) WHERE conv=?", (msg["id"], conv))
+
+    def meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
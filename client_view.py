@@ -0,0 +1,197 @@
+# client_view.py
+# Lista de mensagens da conversa aberta: um QListView sobre um modelo
+# compacto, no lugar do QTextEdit que crescia a cada append().
+#
+# O modelo guarda só (id, remetente, texto) de no máximo MAX_ROWS
+# mensagens; o texto exibido é montado na hora e só para as linhas
+# visíveis. Ao carregar páginas antigas, as mensagens mais novas saem do
+# fim da lista (has_newer) e voltam do cache local quando o usuário desce
+# de novo; mensagens ao vivo empurram as mais antigas para fora do topo.
+#
+# A altura de cada linha (texto quebrado na largura da lista) é calculada
+# uma vez e guardada junto da linha, então carregar uma página só mede as
+# mensagens novas.
+
+from PyQt5 import QtWidgets, QtCore
+
+MAX_ROWS = 1000   # mensagens mantidas em memória pela lista
+
+class MessageModel(QtCore.QAbstractListModel):
+    def __init__(self):
+        super().__init__()
+        self.rows = []            # (id, remetente, texto); id None até o ack
+        self.sizes = []           # (largura, QSize) medido para cada linha, ou None
+        self.has_newer = False    # há mensagens mais novas fora da lista
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        msg_id, sender, text = self.rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return f"[{sender}] {text}"
+        if role == QtCore.Qt.UserRole:
+            return msg_id
+        return None
+
+    def first_id(self):
+        for row in self.rows:
+            if row[0] is not None:
+                return row[0]
+        return None
+
+    def last_id(self):
+        for row in reversed(self.rows):
+            if row[0] is not None:
+                return row[0]
+        return None
+
+    def reset(self, msgs):
+        self.beginResetModel()
+        self.rows = [(m["id"], m["sender"], m["text"]) for m in msgs]
+        self.sizes = [None] * len(self.rows)
+        self.has_newer = False
+        self.endResetModel()
+
+    def insert(self, pos, msgs):
+        if not msgs:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), pos, pos + len(msgs) - 1)
+        self.rows[pos:pos] = [(m["id"], m["sender"], m["text"]) for m in msgs]
+        self.sizes[pos:pos] = [None] * len(msgs)
+        self.endInsertRows()
+
+    def remove(self, first, count):
+        if count <= 0:
+            return
+        self.beginRemoveRows(QtCore.QModelIndex(), first, first + count - 1)
+        del self.rows[first:first + count]
+        del self.sizes[first:first + count]
+        self.endRemoveRows()
+
+    def first_pending(self):
+        # Acks e recusas chegam na ordem dos envios: a primeira linha sem id
+        # é a da mensagem respondida.
+        for i, row in enumerate(self.rows):
+            if row[0] is None:
+                return i
+        return None
+
+    def confirm(self, msg_id):
+        i = self.first_pending()
+        if i is not None:
+            self.rows[i] = (msg_id,) + self.rows[i][1:]
+
+class MessageDelegate(QtWidgets.QStyledItemDelegate):
+    def sizeHint(self, option, index):
+        model = index.model()
+        row = index.row()
+        width = option.rect.width()
+        cached = model.sizes[row]
+        if cached is not None and cached[0] == width:
+            return cached[1]
+        size = super().sizeHint(option, index)
+        model.sizes[row] = (width, size)
+        return size
+
+class ChatView(QtWidgets.QListView):
+    reached_top = QtCore.pyqtSignal()
+    reached_bottom = QtCore.pyqtSignal()   # só quando há mensagens mais novas fora da lista
+
+    def __init__(self, max_rows=MAX_ROWS):
+        super().__init__()
+        self.max_rows = max_rows
+        self.chat_model = MessageModel()
+        self.setModel(self.chat_model)
+        self.setItemDelegate(MessageDelegate(self))
+        self.setWordWrap(True)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+    def count(self):
+        return len(self.chat_model.rows)
+
+    def first_id(self):
+        return self.chat_model.first_id()
+
+    def last_id(self):
+        return self.chat_model.last_id()
+
+    def has_newer(self):
+        return self.chat_model.has_newer
+
+    def at_bottom(self):
+        bar = self.verticalScrollBar()
+        return bar.value() >= bar.maximum() - 4
+
+    def on_scroll(self, value):
+        bar = self.verticalScrollBar()
+        if value == bar.minimum():
+            self.reached_top.emit()
+        elif value == bar.maximum() and self.chat_model.has_newer:
+            self.reached_bottom.emit()
+
+    def wheelEvent(self, event):
+        # Sem barra de rolagem (poucas mensagens) o valor nunca muda.
+        bar = self.verticalScrollBar()
+        if event.angleDelta().y() > 0 and bar.value() == bar.minimum():
+            self.reached_top.emit()
+        super().wheelEvent(event)
+
+    def top_row(self):
+        index = self.indexAt(QtCore.QPoint(0, 0))
+        return index.row() if index.isValid() else 0
+
+    def keep_top(self, row):
+        if 0 <= row < self.count():
+            self.scrollTo(self.chat_model.index(row), QtWidgets.QAbstractItemView.PositionAtTop)
+
+    def set_messages(self, msgs):
+        self.chat_model.reset(msgs)
+        self.scrollToBottom()
+
+    def prepend(self, msgs):
+        """Página mais antiga no topo, mantendo na tela o que estava visível."""
+        top = self.top_row()
+        self.chat_model.insert(0, msgs)
+        excess = self.count() - self.max_rows
+        if excess > 0:
+            self.chat_model.remove(self.count() - excess, excess)
+            self.chat_model.has_newer = True
+        self.keep_top(top + len(msgs))
+
+    def append_page(self, msgs, has_newer):
+        """Página mais nova vinda do cache, ao descer de volta."""
+        top = self.top_row()
+        self.chat_model.insert(self.count(), msgs)
+        self.chat_model.has_newer = has_newer
+        excess = self.count() - self.max_rows
+        if excess > 0:
+            self.chat_model.remove(0, excess)
+        self.keep_top(max(top - max(excess, 0), 0))
+
+    def append_live(self, msg):
+        if self.chat_model.has_newer:
+            return  # o fim da conversa não está na lista; a mensagem fica no cache
+        follow = self.at_bottom()
+        top = self.top_row()
+        self.chat_model.insert(self.count(), [msg])
+        excess = self.count() - self.max_rows
+        if excess > 0:
+            self.chat_model.remove(0, excess)
+        if follow:
+            self.scrollToBottom()
+        else:
+            self.keep_top(max(top - max(excess, 0), 0))
+
+    def confirm(self, msg_id):
+        self.chat_model.confirm(msg_id)
+
+    def discard_pending(self):
+        i = self.chat_model.first_pending()
+        if i is not None:
+            self.chat_model.remove(i, 1)
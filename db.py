@@ -0,0 +1,508 @@
+# db.py
+# Data access for the server: one writer connection, a bounded pool of
+# read-only WAL connections, and the group-commit message writer.
+#
+# Maintenance: python db.py rebuild-fts [database]
+
+import sys
+import sqlite3
+import logging
+import threading
+import queue
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+from metrics import SIZE_BUCKETS, Counter, Histogram
+
+DB_FILE = "rubyruby.db"
+READER_POOL_SIZE = 8
+WRITE_BATCH_SIZE = 256   # max messages committed in one transaction
+WRITE_BATCH_MS = 5       # how long the writer waits to fill a batch
+
+logger = logging.getLogger("rubyruby.db")
+
+LOCK_WAIT = Histogram("rubyruby_lock_wait_seconds", "Time spent waiting to acquire a lock.", ("lock",))
+LOCK_HOLD = Histogram("rubyruby_lock_hold_seconds", "Time a lock was held.", ("lock",))
+EXECUTOR_WAIT = Histogram("rubyruby_db_executor_wait_seconds", "Time a database call queued for a thread.", ("executor",))
+QUERY_TIME = Histogram("rubyruby_db_query_seconds", "Database work by statement, commit included.", ("statement",))
+BATCH_MESSAGES = Histogram("rubyruby_write_batch_messages", "Messages committed per group-commit transaction.",
+                           buckets=SIZE_BUCKETS)
+COMMIT_TIME = Histogram("rubyruby_message_commit_seconds", "Time from submit() to the message being durable.")
+MESSAGES_STORED = Counter("rubyruby_messages_stored_total", "Messages committed to the database.")
+
+# ---------------- Schema ----------------
+def conversation_key(sender: str, target_type: str, target: str) -> str:
+    # A DM between a and b has the same key whoever sends, so one index range
+    # on (conv, id) holds the whole conversation.
+    if target_type == "user":
+        a, b = sorted((sender, target))
+        return f"dm:{a}\x1f{b}"
+    return f"g:{target}"
+
+def init_db(conn: sqlite3.Connection):
+    c = conn.cursor()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS contacts (
+            owner TEXT,
+            contact TEXT,
+            PRIMARY KEY(owner, contact)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER,
+            username TEXT,
+            PRIMARY KEY(group_id, username)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            target_type TEXT,
+            target TEXT,
+            text TEXT,
+            ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+            conv TEXT
+        )
+    """)
+    # Databases created before the conversation key existed get the column
+    # added and backfilled once; the SQL mirrors conversation_key().
+    cols = [r[1] for r in c.execute("PRAGMA table_info(messages)")]
+    if "conv" not in cols:
+        c.execute("ALTER TABLE messages ADD COLUMN conv TEXT")
+    c.execute("""
+        UPDATE messages SET conv = CASE
+            WHEN target_type='user' THEN 'dm:' || min(sender, target) || char(31) || max(sender, target)
+            ELSE 'g:' || target
+        END
+        WHERE conv IS NULL
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv ON messages(conv, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(username, group_id)")
+    # Reconnect catch-up: messages addressed to a user or group, and DMs a
+    # user sent from another device, after a given id.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_target ON messages(target_type, target, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender, id)")
+    init_fts(c)
+    init_conversations(c)
+    init_archive(c)
+    init_attachments(c)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            username TEXT,
+            created_at REAL,
+            expires_at REAL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(username)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions(expires_at)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_cursors (
+            username TEXT PRIMARY KEY,
+            last_id INTEGER
+        )
+    """)
+    conn.commit()
+
+def init_fts(c: sqlite3.Cursor):
+    # External-content FTS5 index over messages.text. The triggers keep it in
+    # the same transaction as every insert/update/delete on messages, so the
+    # writer never has to maintain it by hand.
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone()
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+        USING fts5(text, content='messages', content_rowid='id')
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+        END
+    """)
+    if not exists and c.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+        logger.warning("messages_fts was just created on a database with messages; "
+                       "run 'python db.py rebuild-fts' to index the existing history")
+
+def init_conversations(c: sqlite3.Cursor):
+    # conversations holds the last message and a running message count (seq)
+    # per conversation; read_markers holds, per user, the id and seq read up
+    # to, so unread = seq - read_seq without counting rows. The trigger keeps
+    # both current in the transaction that inserts each message: the sender
+    # has read everything up to their own message, and a DM recipient gets a
+    # marker so the conversation shows up in their list.
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='conversations'").fetchone()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            conv TEXT PRIMARY KEY,
+            last_id INTEGER,
+            last_sender TEXT,
+            last_text TEXT,
+            last_ts DATETIME,
+            seq INTEGER DEFAULT 0
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS read_markers (
+            username TEXT,
+            conv TEXT,
+            read_id INTEGER DEFAULT 0,
+            read_seq INTEGER DEFAULT 0,
+            PRIMARY KEY(username, conv)
+        )
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS conversations_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO conversations (conv, last_id, last_sender, last_text, last_ts, seq)
+            VALUES (new.conv, new.id, new.sender, new.text, new.ts, 1)
+            ON CONFLICT(conv) DO UPDATE SET last_id=excluded.last_id, last_sender=excluded.last_sender,
+                last_text=excluded.last_text, last_ts=excluded.last_ts, seq=seq + 1;
+            INSERT OR IGNORE INTO read_markers (username, conv)
+            SELECT new.target, new.conv WHERE new.target_type='user';
+            INSERT INTO read_markers (username, conv, read_id, read_seq)
+            SELECT new.sender, new.conv, new.id, seq FROM conversations WHERE conv=new.conv
+            ON CONFLICT(username, conv) DO UPDATE SET read_id=excluded.read_id, read_seq=excluded.read_seq;
+        END
+    """)
+    if not exists:
+        # Existing history is summarized once and counted as read.
+        c.execute("""
+            INSERT INTO conversations (conv, last_id, last_sender, last_text, last_ts, seq)
+            SELECT m.conv, m.id, m.sender, m.text, m.ts, x.n
+            FROM (SELECT conv, max(id) AS last, count(*) AS n FROM messages GROUP BY conv) x
+            JOIN messages m ON m.id = x.last
+        """)
+        c.execute("""
+            INSERT OR IGNORE INTO read_markers (username, conv, read_id, read_seq)
+            SELECT p.username, s.conv, s.last_id, s.seq FROM (
+                SELECT sender AS username, conv FROM messages WHERE target_type='user'
+                UNION SELECT target, conv FROM messages WHERE target_type='user'
+            ) p JOIN conversations s ON s.conv = p.conv
+        """)
+        c.execute("""
+            INSERT OR IGNORE INTO read_markers (username, conv, read_id, read_seq)
+            SELECT gm.username, 'g:' || gm.group_id, coalesce(s.last_id, 0), coalesce(s.seq, 0)
+            FROM group_members gm LEFT JOIN conversations s ON s.conv = 'g:' || gm.group_id
+        """)
+
+def init_archive(c: sqlite3.Cursor):
+    # Index of the cold store (see archive.py): one row per segment file and
+    # one per compressed block of a conversation inside it. retention holds
+    # per-conversation hot windows that differ from the default.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            month TEXT,
+            path TEXT,
+            first_id INTEGER,
+            last_id INTEGER,
+            count INTEGER,
+            bytes INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS archive_blocks (
+            conv TEXT,
+            segment_id INTEGER,
+            first_id INTEGER,
+            last_id INTEGER,
+            count INTEGER,
+            offset INTEGER,
+            length INTEGER
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_archive_blocks_conv ON archive_blocks(conv, last_id)")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS retention (
+            conv TEXT PRIMARY KEY,
+            hot_days INTEGER
+        )
+    """)
+
+def init_attachments(c: sqlite3.Cursor):
+    # Uploaded files (see attachments.py): one row per upload, several of
+    # which may share a blob. message_attachments carries the conversation
+    # so access checks need no join, and it stays when its message is
+    # archived.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS attachments (
+            id TEXT PRIMARY KEY,
+            sha256 TEXT,
+            size INTEGER,
+            name TEXT,
+            content_type TEXT,
+            owner TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS message_attachments (
+            message_id INTEGER,
+            attachment_id TEXT,
+            conv TEXT,
+            PRIMARY KEY (message_id, attachment_id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_message_attachments_attachment ON message_attachments(attachment_id, conv)")
+
+def start_reading(conn: sqlite3.Connection, username: str, conv: str):
+    # A new group member starts with nothing unread.
+    conn.execute("""
+        INSERT OR IGNORE INTO read_markers (username, conv, read_id, read_seq)
+        SELECT ?, ?, coalesce(max(last_id), 0), coalesce(max(seq), 0) FROM conversations WHERE conv=?
+    """, (username, conv, conv))
+
+def mark_read(conn: sqlite3.Connection, username: str, conv: str, message_id: Optional[int] = None) -> int:
+    """Move username's read marker in conv forward to message_id (the latest
+    message when None) and return how many messages are still unread."""
+    row = conn.execute("SELECT last_id, seq FROM conversations WHERE conv=?", (conv,)).fetchone()
+    if row is None:
+        return 0
+    last_id, seq = row
+    message_id = last_id if message_id is None else min(message_id, last_id)
+    marker = conn.execute("SELECT read_id, read_seq FROM read_markers WHERE username=? AND conv=?",
+                          (username, conv)).fetchone()
+    read_id, read_seq = marker or (0, 0)
+    if message_id <= read_id:
+        return seq - read_seq
+    if message_id == last_id:
+        read_seq = seq
+    else:
+        # Counts what is left unread, on the (conv, id) index. Those are the
+        # newest messages, so they are still in the hot table even when the
+        # range just read has been archived.
+        read_seq = seq - conn.execute("SELECT count(*) FROM messages WHERE conv=? AND id>?",
+                                      (conv, message_id)).fetchone()[0]
+    conn.execute("""
+        INSERT INTO read_markers (username, conv, read_id, read_seq) VALUES (?, ?, ?, ?)
+        ON CONFLICT(username, conv) DO UPDATE SET read_id=excluded.read_id, read_seq=excluded.read_seq
+    """, (username, conv, message_id, read_seq))
+    return seq - read_seq
+
+def rebuild_fts(conn: sqlite3.Connection):
+    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+    conn.commit()
+
+# ---------------- Connections ----------------
+def connect(path: str, readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets readers proceed during a commit; synchronous=FULL keeps each
+        # commit durable, which is what message acks promise.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+class Database:
+    """Connection owner for the server process.
+
+    Sync code (FastAPI threadpool routes) uses the reader()/writer() context
+    managers directly. Async code awaits read()/write(), which run the given
+    function on a dedicated thread so sqlite never blocks the event loop.
+    Reads and writes have separate executors: a slow query ties up one
+    reader thread, never the writer, and vice versa.
+    """
+
+    def __init__(self, path: str = DB_FILE, readers: int = READER_POOL_SIZE):
+        self.path = path
+        self.write_conn = connect(path)
+        init_db(self.write_conn)
+        self.write_lock = threading.Lock()
+        self.pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=readers)
+        for _ in range(readers):
+            self.pool.put(connect(path, readonly=True))
+        self.read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+    # reader() and writer() take the statement name the block is timed
+    # under in rubyruby_db_query_seconds.
+    @contextmanager
+    def reader(self, statement: str = "other"):
+        start = time.perf_counter()
+        conn = self.pool.get()
+        acquired = time.perf_counter()
+        LOCK_WAIT.observe(acquired - start, "db_read_pool")
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self.pool.put(conn)
+            held = time.perf_counter() - acquired
+            LOCK_HOLD.observe(held, "db_read_pool")
+            QUERY_TIME.observe(held, statement)
+
+    @contextmanager
+    def writer(self, statement: str = "other"):
+        # Commits on a clean exit, rolls back if the block raises.
+        start = time.perf_counter()
+        with self.write_lock:
+            acquired = time.perf_counter()
+            LOCK_WAIT.observe(acquired - start, "db_write")
+            try:
+                yield self.write_conn
+                self.write_conn.commit()
+            except BaseException:
+                self.write_conn.rollback()
+                raise
+            finally:
+                held = time.perf_counter() - acquired
+                LOCK_HOLD.observe(held, "db_write")
+                QUERY_TIME.observe(held, statement)
+
+    def _read(self, fn, args, queued):
+        EXECUTOR_WAIT.observe(time.perf_counter() - queued, "read")
+        with self.reader(fn.__name__) as conn:
+            return fn(conn, *args)
+
+    def _write(self, fn, args, queued):
+        EXECUTOR_WAIT.observe(time.perf_counter() - queued, "write")
+        with self.writer(fn.__name__) as conn:
+            return fn(conn, *args)
+
+    async def read(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.read_executor, self._read, fn, args, time.perf_counter())
+
+    async def write(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.write_executor, self._write, fn, args, time.perf_counter())
+
+# ---------------- Write pipeline ----------------
+MessageRow = Tuple[str, str, str, str, Tuple[str, ...]]  # sender, target_type, target, text, attachment ids
+
+def insert_messages(conn: sqlite3.Connection, rows: List[MessageRow]) -> List[int]:
+    ids = []
+    cur = conn.cursor()
+    for sender, target_type, target, text, attachments in rows:
+        conv = conversation_key(sender, target_type, target)
+        cur.execute("INSERT INTO messages (sender, target_type, target, text, conv) VALUES (?, ?, ?, ?, ?)",
+                    (sender, target_type, target, text, conv))
+        msg_id = cur.lastrowid
+        if attachments:
+            cur.executemany("INSERT OR IGNORE INTO message_attachments (message_id, attachment_id, conv) VALUES (?, ?, ?)",
+                            ((msg_id, attachment_id, conv) for attachment_id in attachments))
+        ids.append(msg_id)
+    MESSAGES_STORED.inc(amount=len(ids))
+    return ids
+
+ImportRow = Tuple[Optional[int], str, str, str, str, Optional[str]]  # id, sender, target_type, target, text, ts
+
+def import_messages(conn: sqlite3.Connection, rows: List[ImportRow], preserve_ids: bool = False) -> int:
+    """Insert exported messages in one transaction; returns how many were
+    new. With preserve_ids, rows whose id already exists are skipped, so an
+    interrupted import can simply be re-run."""
+    cur = conn.cursor()
+    cur.executemany("""
+        INSERT OR IGNORE INTO messages (id, sender, target_type, target, text, ts, conv)
+        VALUES (?, ?, ?, ?, ?, coalesce(?, CURRENT_TIMESTAMP), ?)
+    """, ((msg_id if preserve_ids else None, sender, target_type, target, text, ts,
+           conversation_key(sender, target_type, target))
+          for msg_id, sender, target_type, target, text, ts in rows))
+    return cur.rowcount
+
+class MessageWriter:
+    """Single writer that group-commits queued message inserts.
+
+    Callers await submit() and get the assigned id once the transaction
+    holding their row has committed, so one fsync covers a whole batch.
+    """
+
+    def __init__(self, db: Database, batch_size: int = WRITE_BATCH_SIZE, batch_ms: float = WRITE_BATCH_MS):
+        self.db = db
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, sender: str, target_type: str, target: str, text: str,
+                     attachments: Tuple[str, ...] = ()) -> int:
+        fut = asyncio.get_running_loop().create_future()
+        with COMMIT_TIME.time():
+            await self.queue.put(((sender, target_type, target, text, attachments), fut))
+            return await fut
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.batch_ms / 1000
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    item = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            rows = [row for row, _ in batch]
+            BATCH_MESSAGES.observe(len(rows))
+            try:
+                ids = await self.db.write(insert_messages, rows)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+            else:
+                for (_, fut), msg_id in zip(batch, ids):
+                    if not fut.done():
+                        fut.set_result(msg_id)
+
+if __name__ == "__main__":
+    # python db.py rebuild-fts [database]
+    commands = {"rebuild-fts": rebuild_fts}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.exit(f"usage: python db.py {{{','.join(commands)}}} [database]")
+    conn = connect(sys.argv[2] if len(sys.argv) > 2 else DB_FILE)
+    init_db(conn)
+    commands[sys.argv[1]](conn)
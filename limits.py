@@ -0,0 +1,162 @@
+# limits.py
+# Rate limits and admission control for messages sent over WebSocket.
+#
+# Every message takes a token from its connection's bucket and from its
+# user's bucket, so neither one socket nor many sockets of one account can
+# send faster than the configured rate beyond a short burst. Messages sent
+# in an HTTP batch take from the same user bucket, one token each. A message over
+# the limit is not stored; the sender gets a "throttled" notice naming the
+# limit and when to retry. A client that keeps sending regardless stops
+# getting notices after MAX_NOTICES and is disconnected after MAX_STRIKES.
+#
+# Admission looks at the whole worker rather than one sender: the depth of
+# the group-commit writer's queue and how late the event loop runs its
+# timers. Past the delay thresholds each incoming message waits a little
+# before it is processed, which slows the readers and pushes back on the
+# sockets; past the shed thresholds new messages are refused with a
+# throttled notice until the backlog drains. Messages already accepted are
+# never dropped.
+#
+# Buckets and measurements are per worker.
+
+import os
+import time
+import asyncio
+from typing import Callable, Dict, Optional, Tuple
+
+from metrics import Counter
+
+CONN_RATE = float(os.environ.get("RUBYRUBY_CONN_RATE", "10"))    # messages per second per connection
+CONN_BURST = float(os.environ.get("RUBYRUBY_CONN_BURST", "20"))
+USER_RATE = float(os.environ.get("RUBYRUBY_USER_RATE", "20"))    # messages per second per user, all devices
+USER_BURST = float(os.environ.get("RUBYRUBY_USER_BURST", "40"))
+MAX_NOTICES = 20     # refusals in a row that get a notice; the rest are dropped silently
+MAX_STRIKES = 200    # messages over a rate limit in a row before the socket is closed
+LAG_INTERVAL = 0.05  # seconds between event loop lag samples
+LAG_DELAY, LAG_SHED = 0.05, 0.5          # event loop lag thresholds, seconds
+QUEUE_DELAY, QUEUE_SHED = 1000, 10000    # writer queue depth thresholds, messages
+ADMISSION_DELAY = 0.02   # seconds each message waits while delaying
+SHED_RETRY = 1.0         # retry_after sent while shedding
+
+ADMIT, DELAY, SHED = "admit", "delay", "shed"
+
+THROTTLED = Counter("rubyruby_ws_throttled_total", "Messages refused with a throttled notice.", ("scope",))
+DELAYED = Counter("rubyruby_ws_admission_delayed_total", "Messages held back by admission control.")
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now: Optional[float] = None) -> float:
+        """Take one token; returns 0.0, or the seconds until one is available."""
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst
+
+class UserBuckets:
+    """Buckets of the users with a session on this worker. A full bucket is
+    the same as no bucket, so idle ones are dropped on the next sweep."""
+
+    def __init__(self, rate: float = USER_RATE, burst: float = USER_BURST, sweep_every: float = 60.0):
+        self.rate = rate
+        self.burst = burst
+        self.sweep_every = sweep_every
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.swept = time.monotonic()
+
+    def take(self, username: str, now: float) -> float:
+        bucket = self.buckets.get(username)
+        if bucket is None:
+            bucket = self.buckets[username] = TokenBucket(self.rate, self.burst)
+        wait = bucket.take(now)
+        if now - self.swept >= self.sweep_every:
+            self.swept = now
+            for name in [u for u, b in self.buckets.items() if b.full(now)]:
+                del self.buckets[name]
+        return wait
+
+class Admission:
+    def __init__(self, depth: Callable[[], int]):
+        self.depth = depth
+        self.lag = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.measure())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = loop.time() - start - LAG_INTERVAL
+            # Peaks register at once and fade over a few samples.
+            self.lag = max(lag, self.lag * 0.5)
+
+    def decide(self) -> str:
+        depth = self.depth()
+        if depth >= QUEUE_SHED or self.lag >= LAG_SHED:
+            return SHED
+        if depth >= QUEUE_DELAY or self.lag >= LAG_DELAY:
+            return DELAY
+        return ADMIT
+
+class Limiter:
+    """Checks every message a socket sends; one per connection."""
+
+    def __init__(self, username: str, users: UserBuckets, admission: Admission,
+                 rate: float = CONN_RATE, burst: float = CONN_BURST):
+        self.username = username
+        self.users = users
+        self.admission = admission
+        self.bucket = TokenBucket(rate, burst)
+        self.strikes = 0
+
+    async def check(self) -> Tuple[bool, Optional[dict]]:
+        """(True, None) when the message may go ahead, else (False, the
+        throttled notice for it without its ref, or None to send nothing)."""
+        decision = self.admission.decide()
+        if decision == SHED:
+            return self.refuse("server", SHED_RETRY)
+        if decision == DELAY:
+            DELAYED.inc()
+            await asyncio.sleep(ADMISSION_DELAY)
+        now = time.monotonic()
+        wait = self.bucket.take(now)
+        if wait:
+            return self.refuse("connection", wait)
+        wait = self.users.take(self.username, now)
+        if wait:
+            self.bucket.tokens += 1   # the message was not sent after all
+            return self.refuse("user", wait)
+        self.strikes = 0
+        return True, None
+
+    def refuse(self, scope: str, retry_after: float) -> Tuple[bool, Optional[dict]]:
+        THROTTLED.inc(scope)
+        if scope != "server":
+            self.strikes += 1
+            if self.strikes > MAX_NOTICES:
+                return False, None
+        return False, {"type": "throttled", "scope": scope, "retry_after": round(retry_after, 3)}
+
+    def abusive(self) -> bool:
+        return self.strikes > MAX_STRIKES
@@ -0,0 +1,195 @@
+# presence.py
+# Online status and typing indicators, sent as batched diffs.
+#
+# A user with a session on this worker is a subscriber. It sees the presence
+# of its scope: its contacts and the members of its groups. Nothing is sent
+# when a change happens; changes only mark a user dirty, and every INTERVAL
+# seconds each subscriber gets at most one frame with everything that
+# changed in its scope since the last one:
+#
+#   {"type": "presence", "online": [...], "offline": [...],
+#    "typing": [[from, target_type, to], ...], "stopped": [...]}
+#
+# with empty keys left out. Going offline is only reported once the user has
+# stayed offline for OFFLINE_GRACE seconds, so a reconnect after a network
+# blip shows up as nothing at all to its watchers, and a state that flips
+# back and forth within a tick cancels out. A new session gets the whole
+# picture in one {"type": "presence", "snapshot": true, ...} frame, however
+# large its scope.
+#
+# Typing is scoped to one conversation: a DM's peer, or a group's members.
+# It lasts TYPING_TTL seconds unless refreshed and ends early when the user
+# stops or sends a message; refreshes that change nothing are not sent.
+#
+# Online state comes from the bus, so it is the same on every worker; each
+# worker keeps the scopes and diffs of its own subscribers.
+
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+from metrics import Counter
+
+INTERVAL = float(os.environ.get("RUBYRUBY_PRESENCE_INTERVAL", "1.0"))   # seconds between diffs
+OFFLINE_GRACE = float(os.environ.get("RUBYRUBY_OFFLINE_GRACE", "10"))   # seconds offline before it is shown
+TYPING_TTL = 6.0        # seconds a typing indicator lasts without a refresh
+TYPING_REFRESH = 2.0    # refreshes closer together than this are ignored
+
+logger = logging.getLogger("rubyruby.presence")
+
+FRAMES = Counter("rubyruby_presence_frames_total", "Presence frames sent to sessions.", ("kind",))
+CHANGES = Counter("rubyruby_presence_changes_total", "Presence and typing changes sent, per subscriber.")
+
+Typist = Tuple[str, str, str]   # user, target_type, target as sent (the peer for a DM)
+
+class Presence:
+    """All methods run on the event loop; deliver(usernames, data) writes a
+    frame to the local sessions of usernames."""
+
+    def __init__(self, is_online: Callable[[str], bool], deliver: Callable[[Iterable[str], str], None],
+                 interval: float = INTERVAL, grace: float = OFFLINE_GRACE):
+        self.is_online = is_online
+        self.deliver = deliver
+        self.interval = interval
+        self.grace = grace
+        self.scopes: Dict[str, Set[str]] = {}     # subscriber -> users it sees
+        self.watchers: Dict[str, Set[str]] = {}   # user -> subscribers that see it
+        self.shown: Dict[str, bool] = {}          # state last sent, for users with watchers
+        self.dirty: Dict[str, float] = {}         # user -> when its state last changed
+        self.typists: Dict[Typist, Tuple[float, tuple]] = {}   # -> (expiry, recipients)
+        self.diffs: Dict[str, Dict[str, bool]] = {}        # subscriber -> user -> online
+        self.typing_diffs: Dict[str, Dict[Typist, bool]] = {}   # subscriber -> typist -> typing
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    # ---------------- Scopes ----------------
+    def subscribe(self, username: str, scope: Iterable[str]):
+        """The first local session of username opened; its sessions get a
+        snapshot() rather than a diff of the initial scope."""
+        self.scopes.setdefault(username, set())
+        self.watch(username, scope, announce=False)
+
+    def unsubscribe(self, username: str):
+        """The last local session of username closed."""
+        for user in self.scopes.pop(username, ()):
+            watchers = self.watchers.get(user)
+            if watchers is None:
+                continue
+            watchers.discard(username)
+            if not watchers:
+                del self.watchers[user]
+                self.shown.pop(user, None)
+                self.dirty.pop(user, None)
+        self.diffs.pop(username, None)
+        self.typing_diffs.pop(username, None)
+
+    def watch(self, username: str, users: Iterable[str], announce: bool = True):
+        """Add users to the scope of username, if it is subscribed here."""
+        scope = self.scopes.get(username)
+        if scope is None:
+            return
+        for user in users:
+            if user == username or user in scope:
+                continue
+            scope.add(user)
+            self.watchers.setdefault(user, set()).add(username)
+            if user not in self.shown:
+                self.shown[user] = self.is_online(user)
+            if announce and self.shown[user]:
+                self.diffs.setdefault(username, {})[user] = True
+
+    def snapshot(self, username: str) -> dict:
+        """Everything username sees right now, for a new session."""
+        online = sorted(u for u in self.scopes.get(username, ()) if self.shown.get(u))
+        typing = [list(t) for t, (_, recipients) in self.typists.items() if username in recipients]
+        FRAMES.inc("snapshot")
+        return {"type": "presence", "snapshot": True, "online": online, "typing": typing}
+
+    # ---------------- Changes ----------------
+    def changed(self, users: Iterable[str]):
+        """Users whose online state may have changed; called by the bus."""
+        now = time.monotonic()
+        for user in users:
+            if user in self.watchers:
+                self.dirty[user] = now
+
+    def typing(self, user: str, target_type: str, target: str, recipients: tuple, active: bool):
+        """user started (or refreshed) or stopped typing to target; for a
+        DM, target is the peer and recipients is just the peer."""
+        key = (user, target_type, target)
+        now = time.monotonic()
+        current = self.typists.get(key)
+        if active:
+            self.typists[key] = (now + TYPING_TTL, recipients)
+            if current is not None:
+                return
+        else:
+            if current is None:
+                return
+            del self.typists[key]
+        for subscriber in recipients:
+            if subscriber != user and subscriber in self.scopes:
+                self.typing_diffs.setdefault(subscriber, {})[key] = active
+
+    def is_typing(self, user: str, target_type: str, target: str, refresh: bool = False) -> bool:
+        """Whether user is shown typing to target; with refresh, only when
+        the indicator is fresh enough that a refresh would change nothing."""
+        current = self.typists.get((user, target_type, target))
+        if current is None:
+            return False
+        return not refresh or current[0] - time.monotonic() > TYPING_TTL - TYPING_REFRESH
+
+    # ---------------- Diffs ----------------
+    def collect(self, now: float):
+        for user, since in list(self.dirty.items()):
+            online = self.is_online(user)
+            if online == self.shown.get(user):
+                del self.dirty[user]
+                continue
+            if not online and now - since < self.grace:
+                continue
+            del self.dirty[user]
+            self.shown[user] = online
+            for subscriber in self.watchers.get(user, ()):
+                self.diffs.setdefault(subscriber, {})[user] = online
+        for key, (expiry, recipients) in list(self.typists.items()):
+            if expiry <= now:
+                self.typing(key[0], key[1], key[2], recipients, False)
+
+    def flush(self):
+        self.collect(time.monotonic())
+        diffs, self.diffs = self.diffs, {}
+        typing_diffs, self.typing_diffs = self.typing_diffs, {}
+        for subscriber in diffs.keys() | typing_diffs.keys():
+            frame = {"type": "presence"}
+            users = diffs.get(subscriber, {})
+            typists = typing_diffs.get(subscriber, {})
+            online = sorted(u for u, on in users.items() if on)
+            offline = sorted(u for u, on in users.items() if not on)
+            typing = [list(t) for t, on in typists.items() if on]
+            stopped = [list(t) for t, on in typists.items() if not on]
+            for name, values in (("online", online), ("offline", offline), ("typing", typing), ("stopped", stopped)):
+                if values:
+                    frame[name] = values
+            if len(frame) > 1:
+                FRAMES.inc("diff")
+                CHANGES.inc(amount=len(users) + len(typists))
+                self.deliver((subscriber,), json.dumps(frame))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("presence flush failed: %r", e)
@@ -0,0 +1,216 @@
+# protocol.py
+# Binary WebSocket protocol, shared by the server and the Qt client.
+#
+# A client that offers the PROTOCOL subprotocol at connect gets binary
+# frames; anything else keeps the JSON text protocol, one object per frame.
+#
+# A binary frame is one flag byte, then a body that is zlib-compressed when
+# the flag is FLAG_DEFLATE. The body is one or more records back to back,
+# so a burst of messages queued for a socket goes out as a single frame.
+# A record is a kind byte followed by its fields: unsigned ints as LEB128
+# varints, strings as a varint byte length and UTF-8. Frequent frames have
+# a positional layout with no field names; any other object is carried as
+# a JSON record, so every frame of the text protocol can be sent as-is.
+#
+#   KIND_JSON     text
+#   KIND_MESSAGE  id, from, target_type, to, text, ts (0 absent, else length + 1)
+#   KIND_SEND     ref, target_type, target, text       (client -> server)
+#   KIND_ACK      ref, id
+#   KIND_BACKLOG  count, then count message bodies without their kind byte
+#
+# target_type is an index into TARGET_TYPES.
+
+import json
+import zlib
+from functools import lru_cache
+from typing import Iterable, List
+
+PROTOCOL = "rubyruby.bin.1"
+COMPRESS_MIN = 512       # bodies shorter than this are sent plain
+COMPRESS_LEVEL = 1
+MAX_INFLATED = 16 * 1024 * 1024
+RECORD_CACHE = 1024      # encoded records of recent frames
+
+FLAG_PLAIN, FLAG_DEFLATE = 0, 1
+KIND_JSON, KIND_MESSAGE, KIND_SEND, KIND_ACK, KIND_BACKLOG = range(5)
+TARGET_TYPES = ("user", "group")
+
+MESSAGE_KEYS = {"type", "id", "from", "target_type", "to", "text"}
+SEND_KEYS = {"type", "ref", "target_type", "target", "text"}
+ACK_KEYS = {"type", "ref", "id"}
+
+# ---------------- Encoding ----------------
+def put_uint(out: bytearray, n: int):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def put_str(out: bytearray, s: str):
+    b = s.encode()
+    put_uint(out, len(b))
+    out += b
+
+def is_uint(v) -> bool:
+    return type(v) is int and 0 <= v < 2**63
+
+def compact_message(m) -> bool:
+    keys = m.keys() if isinstance(m, dict) else ()
+    return ((keys == MESSAGE_KEYS or (len(keys) == 7 and keys - {"ts"} == MESSAGE_KEYS and isinstance(m["ts"], str)))
+            and m["type"] == "message" and is_uint(m["id"]) and m["target_type"] in TARGET_TYPES
+            and isinstance(m["from"], str) and isinstance(m["to"], str) and isinstance(m["text"], str))
+
+def put_message(out: bytearray, m: dict):
+    put_uint(out, m["id"])
+    put_str(out, m["from"])
+    out.append(TARGET_TYPES.index(m["target_type"]))
+    put_str(out, m["to"])
+    put_str(out, m["text"])
+    ts = m.get("ts")
+    if ts is None:
+        out.append(0)
+    else:
+        b = ts.encode()
+        put_uint(out, len(b) + 1)
+        out += b
+
+def encode_record(obj: dict) -> bytes:
+    out = bytearray()
+    t = obj.get("type")
+    keys = obj.keys()
+    if t == "message" and compact_message(obj):
+        out.append(KIND_MESSAGE)
+        put_message(out, obj)
+    elif (t == "message" and keys == SEND_KEYS and is_uint(obj["ref"]) and obj["target_type"] in TARGET_TYPES
+          and isinstance(obj["target"], (str, int)) and isinstance(obj["text"], str)):
+        out.append(KIND_SEND)
+        put_uint(out, obj["ref"])
+        out.append(TARGET_TYPES.index(obj["target_type"]))
+        put_str(out, str(obj["target"]))
+        put_str(out, obj["text"])
+    elif t == "ack" and keys == ACK_KEYS and is_uint(obj["ref"]) and is_uint(obj["id"]):
+        out.append(KIND_ACK)
+        put_uint(out, obj["ref"])
+        put_uint(out, obj["id"])
+    elif (t == "backlog" and keys == {"type", "messages"} and isinstance(obj["messages"], list)
+          and all(compact_message(m) for m in obj["messages"])):
+        out.append(KIND_BACKLOG)
+        put_uint(out, len(obj["messages"]))
+        for m in obj["messages"]:
+            put_message(out, m)
+    else:
+        out.append(KIND_JSON)
+        put_str(out, json.dumps(obj))
+    return bytes(out)
+
+@lru_cache(maxsize=RECORD_CACHE)
+def record_from_json(data: str) -> bytes:
+    # The server serializes a frame once for every recipient; with the
+    # cache, so is its binary record.
+    return encode_record(json.loads(data))
+
+def encode_frame(records: Iterable[bytes]) -> bytes:
+    body = b"".join(records)
+    if len(body) >= COMPRESS_MIN:
+        packed = zlib.compress(body, COMPRESS_LEVEL)
+        if len(packed) < len(body):
+            return bytes((FLAG_DEFLATE,)) + packed
+    return bytes((FLAG_PLAIN,)) + body
+
+# ---------------- Decoding ----------------
+def get_uint(buf: bytes, pos: int):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+def get_str(buf: bytes, pos: int):
+    n, pos = get_uint(buf, pos)
+    if pos + n > len(buf):
+        raise ValueError("truncated string")
+    return buf[pos:pos + n].decode(), pos + n
+
+def get_target_type(buf: bytes, pos: int):
+    i, pos = get_uint(buf, pos)
+    if i >= len(TARGET_TYPES):
+        raise ValueError(f"unknown target type {i}")
+    return TARGET_TYPES[i], pos
+
+def get_message(buf: bytes, pos: int):
+    m = {"type": "message"}
+    m["id"], pos = get_uint(buf, pos)
+    m["from"], pos = get_str(buf, pos)
+    m["target_type"], pos = get_target_type(buf, pos)
+    m["to"], pos = get_str(buf, pos)
+    m["text"], pos = get_str(buf, pos)
+    n, pos = get_uint(buf, pos)
+    if n:
+        if pos + n - 1 > len(buf):
+            raise ValueError("truncated string")
+        m["ts"] = buf[pos:pos + n - 1].decode()
+        pos += n - 1
+    return m, pos
+
+def decode_frame(frame: bytes) -> List[dict]:
+    """Objects carried by one binary frame, in order. Raises ValueError on
+    a malformed frame."""
+    if not frame:
+        raise ValueError("empty frame")
+    body = frame[1:]
+    if frame[0] == FLAG_DEFLATE:
+        inflater = zlib.decompressobj()
+        try:
+            body = inflater.decompress(body, MAX_INFLATED)
+        except zlib.error as e:
+            raise ValueError(f"bad compressed frame: {e}") from None
+        if inflater.unconsumed_tail:
+            raise ValueError("frame inflates past the size limit")
+    elif frame[0] != FLAG_PLAIN:
+        raise ValueError(f"unknown frame flags {frame[0]}")
+    out = []
+    pos = 0
+    try:
+        while pos < len(body):
+            kind = body[pos]
+            pos += 1
+            if kind == KIND_MESSAGE:
+                m, pos = get_message(body, pos)
+                out.append(m)
+            elif kind == KIND_SEND:
+                m = {"type": "message"}
+                m["ref"], pos = get_uint(body, pos)
+                m["target_type"], pos = get_target_type(body, pos)
+                m["target"], pos = get_str(body, pos)
+                m["text"], pos = get_str(body, pos)
+                out.append(m)
+            elif kind == KIND_ACK:
+                m = {"type": "ack"}
+                m["ref"], pos = get_uint(body, pos)
+                m["id"], pos = get_uint(body, pos)
+                out.append(m)
+            elif kind == KIND_BACKLOG:
+                count, pos = get_uint(body, pos)
+                msgs = []
+                for _ in range(count):
+                    m, pos = get_message(body, pos)
+                    msgs.append(m)
+                out.append({"type": "backlog", "messages": msgs})
+            elif kind == KIND_JSON:
+                text, pos = get_str(body, pos)
+                obj = json.loads(text)
+                if not isinstance(obj, dict):
+                    raise ValueError("JSON record is not an object")
+                out.append(obj)
+            else:
+                raise ValueError(f"unknown record kind {kind}")
+    except IndexError:
+        raise ValueError("truncated frame") from None
+    except UnicodeDecodeError as e:
+        raise ValueError(f"bad string: {e}") from None
+    return out
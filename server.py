@@ -1,232 +1,1354 @@
-# server.py
-# Execute: uvicorn server:app --host 0.0.0.0 --port 8000
-
-import sqlite3
-import hashlib
-import threading
-import json
-from typing import Dict
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import JSONResponse
-
-DB_FILE = "rubyruby.db"
-lock = threading.Lock()
-app = FastAPI()
-
-# ---------------- Database ----------------
-def get_db_connection():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    return conn
-
-def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password_hash TEXT
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS contacts (
-            owner TEXT,
-            contact TEXT,
-            PRIMARY KEY(owner, contact)
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS groups (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS group_members (
-            group_id INTEGER,
-            username TEXT,
-            PRIMARY KEY(group_id, username)
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender TEXT,
-            target_type TEXT,
-            target TEXT,
-            text TEXT,
-            ts DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.commit()
-    return conn
-
-conn = init_db()
-
-# ---------------- Utilities ----------------
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
-
-# ---------------- HTTP Routes ----------------
-@app.post("/register")
-def register(payload: Dict):
-    username = payload.get("username")
-    password = payload.get("password")
-    if not username or not password:
-        raise HTTPException(400, "username and password required")
-
-    with lock:
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
-        if cur.fetchone():
-            return JSONResponse({"ok": False, "error": "user exists"})
-        cur.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, hash_password(password)))
-        conn.commit()
-    return {"ok": True}
-
-@app.post("/login")
-def login(payload: Dict):
-    username = payload.get("username")
-    password = payload.get("password")
-    if not username or not password:
-        raise HTTPException(400, "username and password required")
-
-    cur = conn.cursor()
-    cur.execute("SELECT password_hash FROM users WHERE username=?", (username,))
-    row = cur.fetchone()
-    if not row or row[0] != hash_password(password):
-        return JSONResponse({"ok": False, "error": "invalid credentials"})
-    return {"ok": True, "token": username}
-
-@app.post("/add_contact")
-def add_contact(payload: Dict):
-    owner = payload.get("owner")
-    contact = payload.get("contact")
-    if not owner or not contact:
-        raise HTTPException(400, "owner and contact required")
-    with lock:
-        cur = conn.cursor()
-        cur.execute("INSERT OR IGNORE INTO contacts (owner, contact) VALUES (?, ?)", (owner, contact))
-        conn.commit()
-    return {"ok": True}
-
-@app.post("/create_group")
-def create_group(payload: Dict):
-    name = payload.get("name")
-    owner = payload.get("owner")
-    if not name or not owner:
-        raise HTTPException(400, "name and owner required")
-    with lock:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO groups (name) VALUES (?)", (name,))
-        gid = cur.lastrowid
-        cur.execute("INSERT INTO group_members (group_id, username) VALUES (?, ?)", (gid, owner))
-        conn.commit()
-    return {"ok": True, "group_id": gid}
-
-@app.post("/join_group")
-def join_group(payload: Dict):
-    gid = payload.get("group_id")
-    username = payload.get("user")
-    if not gid or not username:
-        raise HTTPException(400, "group_id and user required")
-    with lock:
-        cur = conn.cursor()
-        cur.execute("INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)", (gid, username))
-        conn.commit()
-    return {"ok": True}
-
-@app.get("/contacts/{username}")
-def get_contacts(username: str):
-    cur = conn.cursor()
-    cur.execute("SELECT contact FROM contacts WHERE owner=?", (username,))
-    contacts = [r[0] for r in cur.fetchall()]
-    return {"contacts": contacts}
-
-@app.get("/groups/{username}")
-def get_groups(username: str):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT g.id, g.name FROM groups g
-        JOIN group_members gm ON g.id=gm.group_id
-        WHERE gm.username=?
-    """, (username,))
-    groups = [{"id": r[0], "name": r[1]} for r in cur.fetchall()]
-    return {"groups": groups}
-
-@app.get("/messages/{username}/{target_type}/{target}")
-def get_messages(username: str, target_type: str, target: str):
-    cur = conn.cursor()
-    if target_type == "user":
-        cur.execute("""
-            SELECT sender, text, ts FROM messages
-            WHERE (sender=? AND target=? AND target_type='user')
-               OR (sender=? AND target=? AND target_type='user')
-            ORDER BY id
-        """, (username, target, target, username))
-    else:
-        cur.execute("""
-            SELECT sender, text, ts FROM messages
-            WHERE target_type='group' AND target=?
-            ORDER BY id
-        """, (target,))
-    msgs = [{"sender": r[0], "text": r[1], "ts": r[2]} for r in cur.fetchall()]
-    return {"messages": msgs}
-
-# ---------------- WebSocket ----------------
-class WSManager:
-    def __init__(self):
-        self.connections: Dict[str, WebSocket] = {}
-        self.lock = threading.Lock()
-
-    async def connect(self, username: str, ws: WebSocket):
-        await ws.accept()
-        with self.lock:
-            self.connections[username] = ws
-
-    def disconnect(self, username: str):
-        with self.lock:
-            self.connections.pop(username, None)
-
-    async def send(self, username: str, message: dict):
-        ws = self.connections.get(username)
-        if ws:
-            try:
-                await ws.send_text(json.dumps(message))
-            except:
-                pass
-
-    async def broadcast_group(self, group_id: str, message: dict):
-        cur = conn.cursor()
-        cur.execute("SELECT username FROM group_members WHERE group_id=?", (group_id,))
-        members = [r[0] for r in cur.fetchall()]
-        for m in members:
-            await self.send(m, message)
-
-ws_manager = WSManager()
-
-@app.websocket("/ws/{token}")
-async def websocket_endpoint(ws: WebSocket, token: str):
-    username = token
-    await ws_manager.connect(username, ws)
-    try:
-        while True:
-            data = await ws.receive_text()
-            msg = json.loads(data)
-            if msg.get("type") == "message":
-                target_type = msg.get("target_type")
-                target = str(msg.get("target"))
-                text = msg.get("text")
-                with lock:
-                    cur = conn.cursor()
-                    cur.execute("INSERT INTO messages (sender, target_type, target, text) VALUES (?, ?, ?, ?)",
-                                (username, target_type, target, text))
-                    conn.commit()
-                payload = {"type": "message", "from": username, "to": target, "text": text, "target_type": target_type}
-                if target_type == "user":
-                    await ws_manager.send(target, payload)
-                else:
-                    await ws_manager.broadcast_group(target, payload)
-    except WebSocketDisconnect:
-        ws_manager.disconnect(username)
-    except Exception:
-        ws_manager.disconnect(username)
+# server.py
+# Execute: uvicorn server:app --host 0.0.0.0 --port 8000
+
+import os
+import hmac
+import heapq
+import hashlib
+import secrets
+import threading
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from fastapi import Depends, FastAPI, Header, Query, Request, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from anyio.from_thread import run_sync as run_on_loop
+
+from db import (DB_FILE, Database, MessageWriter, conversation_key, import_messages, insert_messages,
+                mark_read, start_reading)
+from bus import create_bus
+from metrics import SIZE_BUCKETS, Counter, Gauge, Histogram, HTTPMetrics, render as render_metrics
+from sessions import Sessions
+from archive import HOT_DAYS, Archive, Archiver, default_dir
+from presence import Presence
+from limits import SHED, SHED_RETRY, THROTTLED, Admission, Limiter, UserBuckets
+from attachments import MAX_ATTACHMENT, MAX_ATTACHMENTS, Store, attachment_dir, clean_name
+from protocol import PROTOCOL, decode_frame, encode_frame, encode_record, record_from_json
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_MESSAGE_ID = 2**63 - 1
+SEARCH_CANDIDATES = 2000   # most recent matches ranked per search
+MAX_BATCH = 1000   # items per batch request
+EXPORT_BATCH = 5000   # rows per read transaction while exporting
+IMPORT_BATCH = 10000  # rows per write transaction while importing
+MAX_IMPORT_LINE = 1024 * 1024
+SEND_TIMEOUT = 2.0   # seconds a single frame may take to reach a client
+OUTBOUND_QUEUE_SIZE = 256   # frames buffered per connection
+BATCH_FRAMES = 64       # queued frames a binary session may send as one
+BATCH_BYTES = 64 * 1024
+BACKLOG_BATCH = 200   # messages per catch-up frame on reconnect
+MAX_BACKLOG = 5000    # past this, the client is told to resync over HTTP
+CURSOR_FLUSH_SECONDS = 5.0
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+SLOW_CONSUMER_POLICY = os.environ.get("RUBYRUBY_SLOW_CONSUMER", "drop_oldest")
+if SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    # Checked here so the server refuses to start, rather than every socket failing after accept.
+    raise ValueError(f"unsupported RUBYRUBY_SLOW_CONSUMER: {SLOW_CONSUMER_POLICY}")
+ADMIN_TOKEN = os.environ.get("RUBYRUBY_ADMIN_TOKEN", "")   # operator routes are off while unset
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2**14, 8, 1   # ~16 MiB and tens of ms per hash
+KDF_WORKERS = 4   # concurrent password hashes; logins beyond that queue
+
+logger = logging.getLogger("rubyruby")
+
+db = Database(DB_FILE)
+writer = MessageWriter(db)
+bus = create_bus()
+sessions = Sessions(db)
+user_buckets = UserBuckets()
+admission = Admission(writer.depth)
+archive = Archive(default_dir(DB_FILE))
+archiver = Archiver(db, archive)
+store = Store(attachment_dir(DB_FILE))
+presence = Presence(bus.is_online, lambda usernames, data: ws_manager.deliver(usernames, data))
+kdf_executor = ThreadPoolExecutor(max_workers=KDF_WORKERS, thread_name_prefix="kdf")
+
+# ---------------- Metrics ----------------
+HTTP_LATENCY = Histogram("rubyruby_http_request_seconds", "HTTP request latency.", ("method", "route", "status"))
+FRAMES_RECEIVED = Counter("rubyruby_ws_frames_received_total", "Frames received from WebSocket clients.")
+FRAMES_SENT = Counter("rubyruby_ws_frames_sent_total", "Frames written to WebSocket clients.")
+BYTES_SENT = Counter("rubyruby_ws_bytes_sent_total", "Bytes written to WebSocket clients, before permessage-deflate.",
+                     ("protocol",))
+FRAMES_DROPPED = Counter("rubyruby_ws_frames_dropped_total", "Queued frames discarded for slow consumers.", ("policy",))
+BROADCAST_TIME = Histogram("rubyruby_broadcast_seconds", "Group fan-out time, membership lookup included.")
+BROADCAST_SIZE = Histogram("rubyruby_broadcast_recipients", "Members per group broadcast.", buckets=SIZE_BUCKETS)
+
+# Gauges are read when /metrics is scraped, on the event loop thread.
+def open_connections():
+    return [c for conns in ws_manager.connections.values() for c in conns]
+
+Gauge("rubyruby_ws_connections", "Open WebSocket sessions.", collect=lambda: [((), len(open_connections()))])
+Gauge("rubyruby_ws_users", "Users with at least one open session.", collect=lambda: [((), len(ws_manager.connections))])
+Gauge("rubyruby_ws_outbound_queued", "Frames waiting in outbound queues, total and deepest session.", ("stat",),
+      collect=lambda: [(("total",), sum(len(c.queue) for c in open_connections())),
+                       (("max",), max((len(c.queue) for c in open_connections()), default=0))])
+Gauge("rubyruby_writer_queue_depth", "Messages waiting for the group-commit writer.", collect=lambda: [((), writer.depth())])
+Gauge("rubyruby_db_readers_idle", "Read connections free in the pool.", collect=lambda: [((), db.pool.qsize())])
+Gauge("rubyruby_presence_subscribers", "Users whose presence diffs this worker sends.",
+      collect=lambda: [((), len(presence.scopes))])
+Gauge("rubyruby_event_loop_lag_seconds", "Recent event loop lag, decaying peak.", collect=lambda: [((), admission.lag)])
+
+# ---------------- Utilities ----------------
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${key.hex()}"
+
+def verify_password(password: str, stored: str) -> bool:
+    if not stored.startswith("scrypt$"):
+        # Unsalted sha256 from before the KDF; replaced at the next login.
+        return hmac.compare_digest(stored, hashlib.sha256(password.encode()).hexdigest())
+    _, n, r, p, salt, key = stored.split("$")
+    candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(candidate.hex(), key)
+
+# Checked when the user doesn't exist, so a failed login takes as long
+# either way.
+DUMMY_HASH = hash_password(secrets.token_hex(8))
+
+async def run_kdf(fn, *args):
+    # Hashing runs on its own small pool: it neither blocks the event loop
+    # nor starves the threadpool the sync routes run on.
+    return await asyncio.get_running_loop().run_in_executor(kdf_executor, fn, *args)
+
+async def current_user(authorization: Optional[str] = Header(None)) -> str:
+    """Username behind the request's "Authorization: Bearer <token>"."""
+    scheme, _, token = (authorization or "").partition(" ")
+    username = await sessions.validate(token) if scheme.lower() == "bearer" and token else None
+    if username is None:
+        raise HTTPException(401, "invalid or expired session")
+    return username
+
+async def own_user(username: str, user: str = Depends(current_user)) -> str:
+    # For routes with {username} in the path: only that user may call them.
+    if user != username:
+        raise HTTPException(403, "forbidden")
+    return username
+
+async def operator(authorization: Optional[str] = Header(None)):
+    # Whole-database routes take the operator token, not a user session.
+    scheme, _, token = (authorization or "").partition(" ")
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, "operator routes are disabled; set RUBYRUBY_ADMIN_TOKEN")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(401, "operator token required")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    writer.start()
+    admission.start()
+    await bus.start(ws_manager.deliver, on_control, presence.changed)
+    presence.start()
+    flusher = asyncio.create_task(ws_manager.run_cursor_flusher())
+    archiving = asyncio.create_task(archiver.run()) if archiver.interval > 0 else None
+    yield
+    flusher.cancel()
+    if archiving:
+        archiving.cancel()
+    presence.stop()
+    await bus.stop()
+    await ws_manager.flush_cursors()
+    admission.stop()
+    await writer.stop()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(HTTPMetrics, histogram=HTTP_LATENCY)
+
+# ---------------- HTTP Routes ----------------
+def insert_user(conn, username: str, password_hash: str) -> bool:
+    cur = conn.cursor()
+    cur.execute("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
+    return cur.rowcount == 1
+
+def fetch_password_hash(conn, username: str) -> Optional[str]:
+    row = conn.execute("SELECT password_hash FROM users WHERE username=?", (username,)).fetchone()
+    return row[0] if row else None
+
+def update_password_hash(conn, username: str, password_hash: str):
+    conn.execute("UPDATE users SET password_hash=? WHERE username=?", (password_hash, username))
+
+@app.post("/register")
+async def register(payload: Dict):
+    username = payload.get("username")
+    password = payload.get("password")
+    if not username or not password:
+        raise HTTPException(400, "username and password required")
+    if any(ord(ch) < 32 for ch in username):
+        raise HTTPException(400, "invalid username")
+
+    password_hash = await run_kdf(hash_password, password)
+    if not await db.write(insert_user, username, password_hash):
+        return JSONResponse({"ok": False, "error": "user exists"})
+    return {"ok": True}
+
+@app.post("/login")
+async def login(payload: Dict):
+    username = payload.get("username")
+    password = payload.get("password")
+    if not username or not password:
+        raise HTTPException(400, "username and password required")
+
+    stored = await db.read(fetch_password_hash, username)
+    if not await run_kdf(verify_password, password, stored or DUMMY_HASH) or stored is None:
+        return JSONResponse({"ok": False, "error": "invalid credentials"})
+    if not stored.startswith("scrypt$"):
+        await db.write(update_password_hash, username, await run_kdf(hash_password, password))
+    token, expires_at = await sessions.create(username)
+    return {"ok": True, "token": token, "expires_at": expires_at}
+
+@app.post("/logout")
+async def logout(payload: Dict, authorization: Optional[str] = Header(None), user: str = Depends(current_user)):
+    """End the calling session, or every session of the user with {"all": true}."""
+    if payload.get("all"):
+        await sessions.revoke_user(user)
+        bus.broadcast_control({"type": "sessions_revoked", "user": user})
+    else:
+        key = await sessions.revoke(authorization.partition(" ")[2])
+        bus.broadcast_control({"type": "session_revoked", "key": key})
+    return {"ok": True}
+
+@app.post("/add_contact")
+def add_contact(payload: Dict, user: str = Depends(current_user)):
+    owner = payload.get("owner")
+    contact = payload.get("contact")
+    if not owner or not contact:
+        raise HTTPException(400, "owner and contact required")
+    if owner != user:
+        raise HTTPException(403, "forbidden")
+    with db.writer("add_contact") as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO contacts (owner, contact) VALUES (?, ?)", (owner, contact))
+    run_on_loop(contacts_added, [(owner, contact)])
+    run_on_loop(bus.broadcast_control, {"type": "contacts_added", "contacts": [(owner, contact)]})
+    return {"ok": True}
+
+@app.post("/create_group")
+def create_group(payload: Dict, user: str = Depends(current_user)):
+    name = payload.get("name")
+    owner = payload.get("owner")
+    if not name or not owner:
+        raise HTTPException(400, "name and owner required")
+    if owner != user:
+        raise HTTPException(403, "forbidden")
+    with db.writer("create_group") as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO groups (name) VALUES (?)", (name,))
+        gid = cur.lastrowid
+        cur.execute("INSERT INTO group_members (group_id, username) VALUES (?, ?)", (gid, owner))
+        start_reading(conn, owner, f"g:{gid}")
+    memberships.create(gid, owner)
+    run_on_loop(bus.broadcast_control, {"type": "member_added", "group_id": gid, "user": owner})
+    return {"ok": True, "group_id": gid}
+
+@app.post("/join_group", dependencies=[Depends(current_user)])
+def join_group(payload: Dict):
+    gid = payload.get("group_id")
+    username = payload.get("user")
+    if not gid or not username:
+        raise HTTPException(400, "group_id and user required")
+    with db.writer("join_group") as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)", (gid, username))
+        start_reading(conn, username, f"g:{gid}")
+    memberships.add(gid, username)
+    run_on_loop(groups_joined, [(gid, username)])
+    run_on_loop(bus.broadcast_control, {"type": "member_added", "group_id": gid, "user": username})
+    return {"ok": True}
+
+# ---------------- Batch Routes ----------------
+# Each takes {"items": [...]} where an item has the shape of the matching
+# single-item payload, applies every valid item in one transaction and
+# answers with one result per item, in order.
+
+def batch_items(payload: Dict) -> list:
+    items = payload.get("items")
+    if not isinstance(items, list):
+        raise HTTPException(400, "items required")
+    if len(items) > MAX_BATCH:
+        raise HTTPException(400, f"at most {MAX_BATCH} items per batch")
+    return [item if isinstance(item, dict) else {} for item in items]
+
+@app.post("/add_contacts")
+def add_contacts(payload: Dict, user: str = Depends(current_user)):
+    items = batch_items(payload)
+    results = []
+    added = []
+    with db.writer("add_contacts") as conn:
+        cur = conn.cursor()
+        for item in items:
+            owner, contact = item.get("owner"), item.get("contact")
+            if not owner or not contact:
+                results.append({"ok": False, "error": "owner and contact required"})
+                continue
+            if owner != user:
+                results.append({"ok": False, "error": "forbidden"})
+                continue
+            cur.execute("INSERT OR IGNORE INTO contacts (owner, contact) VALUES (?, ?)", (owner, contact))
+            results.append({"ok": True, "added": cur.rowcount == 1})
+            if cur.rowcount == 1:
+                added.append((owner, contact))
+    if added:
+        run_on_loop(contacts_added, added)
+        run_on_loop(bus.broadcast_control, {"type": "contacts_added", "contacts": added})
+    return {"results": results}
+
+@app.post("/create_groups")
+def create_groups(payload: Dict, user: str = Depends(current_user)):
+    items = batch_items(payload)
+    results, created = [], []
+    with db.writer("create_groups") as conn:
+        cur = conn.cursor()
+        for item in items:
+            name, owner = item.get("name"), item.get("owner")
+            if not name or not owner:
+                results.append({"ok": False, "error": "name and owner required"})
+                continue
+            if owner != user:
+                results.append({"ok": False, "error": "forbidden"})
+                continue
+            cur.execute("INSERT INTO groups (name) VALUES (?)", (name,))
+            gid = cur.lastrowid
+            cur.execute("INSERT INTO group_members (group_id, username) VALUES (?, ?)", (gid, owner))
+            start_reading(conn, owner, f"g:{gid}")
+            created.append((gid, owner))
+            results.append({"ok": True, "group_id": gid})
+    for gid, owner in created:
+        memberships.create(gid, owner)
+    if created:
+        run_on_loop(bus.broadcast_control, {"type": "members_added", "members": created})
+    return {"results": results}
+
+@app.post("/join_groups", dependencies=[Depends(current_user)])
+def join_groups(payload: Dict):
+    items = batch_items(payload)
+    results, added = [], []
+    with db.writer("join_groups") as conn:
+        cur = conn.cursor()
+        for item in items:
+            gid, username = item.get("group_id"), item.get("user")
+            if not gid or not username:
+                results.append({"ok": False, "error": "group_id and user required"})
+                continue
+            if not isinstance(gid, int) or isinstance(gid, bool):
+                results.append({"ok": False, "error": "group_id must be an integer"})
+                continue
+            if not cur.execute("SELECT 1 FROM groups WHERE id=?", (gid,)).fetchone():
+                results.append({"ok": False, "error": "unknown group"})
+                continue
+            cur.execute("INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)", (gid, username))
+            results.append({"ok": True, "added": cur.rowcount == 1})
+            if cur.rowcount == 1:
+                # Existing members keep their read marker and are not announced again.
+                start_reading(conn, username, f"g:{gid}")
+                added.append((gid, username))
+    for gid, username in added:
+        memberships.add(gid, username)
+    if added:
+        run_on_loop(groups_joined, added)
+        run_on_loop(bus.broadcast_control, {"type": "members_added", "members": added})
+    return {"results": results}
+
+@app.post("/send_messages")
+async def send_messages(payload: Dict, user: str = Depends(current_user)):
+    """Store a batch of messages in one transaction, then deliver each one
+    over WebSocket exactly as if it had been sent on a socket. Each message
+    takes a token from the sender's bucket, shared with their sockets; one
+    over the limit gets a throttled result and is not stored."""
+    items = batch_items(payload)
+    if admission.decide() == SHED:
+        return JSONResponse({"ok": False, "error": "server busy"}, status_code=503,
+                            headers={"Retry-After": str(int(SHED_RETRY))})
+    results, rows, files = [], [], []
+    for item in items:
+        sender, target_type, target, text = item.get("sender"), item.get("target_type"), item.get("target"), item.get("text")
+        if not sender or target_type not in ("user", "group") or target is None or not isinstance(text, str):
+            results.append({"ok": False, "error": "sender, target_type, target and text required"})
+            continue
+        if sender != user:
+            results.append({"ok": False, "error": "forbidden"})
+            continue
+        wait = user_buckets.take(user, time.monotonic())
+        if wait:
+            THROTTLED.inc("user")
+            results.append({"ok": False, "error": "throttled", "scope": "user", "retry_after": round(wait, 3)})
+            continue
+        ids = attachment_ids(item.get("attachments"))
+        attached = await resolve_attachments(user, ids) if ids else []
+        if ids is None or attached is None:
+            results.append({"ok": False, "error": attachment_error(ids)})
+            continue
+        rows.append((sender, target_type, str(target), text, ids))
+        files.append(attached)
+        results.append(None)
+    ids = await db.write(insert_messages, rows) if rows else []
+    stored = iter(zip(rows, files, ids))
+    for i, result in enumerate(results):
+        if result is None:
+            (sender, target_type, target, text, _), attached, msg_id = next(stored)
+            results[i] = {"ok": True, "id": msg_id}
+            await fan_out(msg_id, sender, target_type, target, text, attached)
+    return {"results": results}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # async so the gauges see WSManager state from the loop thread.
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/contacts/{username}", dependencies=[Depends(own_user)])
+def get_contacts(username: str):
+    with db.reader("get_contacts") as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT contact FROM contacts WHERE owner=?", (username,))
+        contacts = [r[0] for r in cur.fetchall()]
+    return {"contacts": contacts}
+
+@app.get("/groups/{username}", dependencies=[Depends(own_user)])
+def get_groups(username: str):
+    with db.reader("get_groups") as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT g.id, g.name FROM groups g
+            JOIN group_members gm ON g.id=gm.group_id
+            WHERE gm.username=?
+        """, (username,))
+        groups = [{"id": r[0], "name": r[1]} for r in cur.fetchall()]
+    return {"groups": groups}
+
+def fetch_conversations(conn, username: str):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT r.conv, s.last_id, s.last_sender, s.last_text, s.last_ts, s.seq - r.read_seq
+        FROM read_markers r LEFT JOIN conversations s ON s.conv = r.conv
+        WHERE r.username=?
+    """, (username,))
+    summaries = {r[0]: r[1:] for r in cur.fetchall()}
+    cur.execute("SELECT contact FROM contacts WHERE owner=?", (username,))
+    contacts = [r[0] for r in cur.fetchall()]
+    cur.execute("""
+        SELECT g.id, g.name FROM groups g
+        JOIN group_members gm ON g.id=gm.group_id
+        WHERE gm.username=?
+    """, (username,))
+    return summaries, contacts, cur.fetchall()
+
+def dm_peer(conv: str, username: str) -> str:
+    a, b = conv[len("dm:"):].split("\x1f")
+    return b if a == username else a
+
+@app.get("/conversations/{username}", dependencies=[Depends(own_user)])
+def get_conversations(username: str):
+    """Every DM (with a contact or anyone who has messaged) and group of
+    username, most recently active first, with last message and unread count."""
+    with db.reader("fetch_conversations") as conn:
+        summaries, contacts, groups = fetch_conversations(conn, username)
+    entries = [("user", peer, peer) for peer in sorted(set(contacts).union(
+        dm_peer(conv, username) for conv in summaries if conv.startswith("dm:")))]
+    entries += [("group", str(gid), name) for gid, name in groups]
+    result = []
+    for target_type, target, name in entries:
+        last_id, sender, text, ts, unread = summaries.get(conversation_key(username, target_type, target), (None,) * 5)
+        result.append({
+            "target_type": target_type,
+            "target": target,
+            "name": name,
+            "last_message": {"id": last_id, "sender": sender, "text": text, "ts": ts} if last_id else None,
+            "unread": unread or 0,
+        })
+    result.sort(key=lambda c: -(c["last_message"]["id"] if c["last_message"] else 0))
+    return {"conversations": result}
+
+@app.post("/conversations/{username}/read", dependencies=[Depends(own_user)])
+def mark_conversation_read(username: str, payload: Dict):
+    target_type = payload.get("target_type")
+    target = payload.get("target")
+    if target_type not in ("user", "group") or target is None:
+        raise HTTPException(400, "target_type and target required")
+    message_id = payload.get("message_id")
+    if message_id is not None and (not isinstance(message_id, int) or isinstance(message_id, bool)):
+        raise HTTPException(400, "message_id must be an integer or null")
+    with db.writer("mark_read") as conn:
+        unread = mark_read(conn, username, conversation_key(username, target_type, str(target)), message_id)
+    return {"ok": True, "unread": unread}
+
+def check_member(conn, username: str, target_type: str, target: str):
+    # Reading or configuring a group conversation takes membership; a DM key
+    # is built from username, so it only ever names one of theirs. Any other
+    # target_type would still make a group key, so it is refused outright.
+    if target_type not in ("user", "group"):
+        raise HTTPException(400, "target_type must be user or group")
+    if target_type == "group" and not conn.execute(
+            "SELECT 1 FROM group_members WHERE group_id=? AND username=?", (target, username)).fetchone():
+        raise HTTPException(403, "forbidden")
+
+def page_rows(archived):
+    return [(r[0], r[1], r[4], r[5]) for r in archived]
+
+def fetch_page(conn, conv: str, before_id: Optional[int], after_id: Optional[int], limit: int):
+    # Fetch one extra row to know whether another page exists. Archived ids
+    # of a conversation are all below its hot ones, so a page continues in
+    # the archive past the oldest hot message, and starts there when paging
+    # forward from an archived id.
+    cur = conn.cursor()
+    if after_id is not None:
+        rows = []
+        if archive.has_after(conn, conv, after_id):
+            rows = page_rows(archive.after(conn, conv, after_id, limit + 1))
+            after_id = rows[-1][0]
+        if len(rows) <= limit:
+            cur.execute("""
+                SELECT id, sender, text, ts FROM messages
+                WHERE conv=? AND id>?
+                ORDER BY id LIMIT ?
+            """, (conv, after_id, limit + 1 - len(rows)))
+            rows += cur.fetchall()
+        return rows[:limit], len(rows) > limit
+    before_id = before_id if before_id is not None else MAX_MESSAGE_ID
+    cur.execute("""
+        SELECT id, sender, text, ts FROM messages
+        WHERE conv=? AND id<?
+        ORDER BY id DESC LIMIT ?
+    """, (conv, before_id, limit + 1))
+    rows = cur.fetchall()
+    if len(rows) <= limit:
+        rows += page_rows(archive.before(conn, conv, rows[-1][0] if rows else before_id, limit + 1 - len(rows)))
+    return rows[:limit][::-1], len(rows) > limit
+
+@app.get("/messages/{username}/{target_type}/{target}", dependencies=[Depends(own_user)])
+def get_messages(username: str, target_type: str, target: str,
+                 before_id: Optional[int] = Query(None, ge=0, le=MAX_MESSAGE_ID),
+                 after_id: Optional[int] = Query(None, ge=0, le=MAX_MESSAGE_ID),
+                 limit: int = PAGE_SIZE):
+    if before_id is not None and after_id is not None:
+        raise HTTPException(400, "before_id and after_id are mutually exclusive")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    conv = conversation_key(username, target_type, target)
+    with db.reader("fetch_page") as conn:
+        check_member(conn, username, target_type, target)
+        rows, more = fetch_page(conn, conv, before_id, after_id, limit)
+        files = fetch_message_attachments(conn, [r[0] for r in rows])
+    msgs = [with_attachments({"id": r[0], "sender": r[1], "text": r[2], "ts": r[3]}, files) for r in rows]
+    next_cursor = None
+    if more and rows:
+        next_cursor = rows[-1][0] if after_id is not None else rows[0][0]
+    return {"messages": msgs, "next_cursor": next_cursor}
+
+def fetch_retention(conn, conv: str) -> Optional[int]:
+    row = conn.execute("SELECT hot_days FROM retention WHERE conv=?", (conv,)).fetchone()
+    return row[0] if row else None
+
+@app.get("/retention/{username}/{target_type}/{target}", dependencies=[Depends(own_user)])
+def get_retention(username: str, target_type: str, target: str):
+    with db.reader("fetch_retention") as conn:
+        check_member(conn, username, target_type, target)
+        hot_days = fetch_retention(conn, conversation_key(username, target_type, target))
+    return {"hot_days": hot_days or HOT_DAYS, "default": hot_days is None}
+
+@app.put("/retention/{username}/{target_type}/{target}", dependencies=[Depends(own_user)])
+def set_retention(username: str, target_type: str, target: str, payload: Dict):
+    """Days a conversation's messages stay in the hot table before they are
+    archived; {"hot_days": null} goes back to the default."""
+    hot_days = payload.get("hot_days")
+    if hot_days is not None and (not isinstance(hot_days, int) or hot_days < 1):
+        raise HTTPException(400, "hot_days must be a positive integer or null")
+    conv = conversation_key(username, target_type, target)
+    with db.writer("set_retention") as conn:
+        check_member(conn, username, target_type, target)
+        if hot_days is None:
+            conn.execute("DELETE FROM retention WHERE conv=?", (conv,))
+        else:
+            conn.execute("INSERT OR REPLACE INTO retention (conv, hot_days) VALUES (?, ?)", (conv, hot_days))
+    return {"ok": True, "hot_days": hot_days or HOT_DAYS}
+
+# ---------------- Attachments ----------------
+# Files are uploaded on their own, then sent by listing their ids in a
+# message's "attachments"; see attachments.py. Delivered messages and
+# history carry {"id", "name", "size", "content_type"} for each one.
+
+def insert_attachment(conn, attachment_id: str, sha256: str, size: int, name: str, content_type: str, owner: str):
+    conn.execute("""
+        INSERT INTO attachments (id, sha256, size, name, content_type, owner) VALUES (?, ?, ?, ?, ?, ?)
+    """, (attachment_id, sha256, size, name, content_type, owner))
+
+def readable_attachments(conn, username: str, ids) -> Dict[str, tuple]:
+    """id -> (sha256, size, name, content_type) of those ids username may
+    read: their own uploads, and files sent in one of their DMs or groups."""
+    # DM keys are "dm:<a>\x1f<b>" and usernames have no control characters,
+    # so a prefix or suffix match names a participant exactly.
+    prefix, suffix = f"dm:{username}\x1f", f"\x1f{username}"
+    cur = conn.execute(f"""
+        SELECT a.id, a.sha256, a.size, a.name, a.content_type FROM attachments a
+        WHERE a.id IN ({",".join("?" * len(ids))}) AND (a.owner=? OR EXISTS (
+            SELECT 1 FROM message_attachments ma WHERE ma.attachment_id=a.id AND (
+                substr(ma.conv, 1, ?)=? OR (ma.conv LIKE 'dm:%' AND substr(ma.conv, -?)=?)
+                OR ma.conv IN (SELECT 'g:' || group_id FROM group_members WHERE username=?))))
+    """, (*ids, username, len(prefix), prefix, len(suffix), suffix, username))
+    return {r[0]: r[1:] for r in cur.fetchall()}
+
+def fetch_message_attachments(conn, message_ids) -> Dict[int, list]:
+    if not message_ids:
+        return {}
+    cur = conn.execute(f"""
+        SELECT ma.message_id, a.id, a.name, a.size, a.content_type
+        FROM message_attachments ma JOIN attachments a ON a.id = ma.attachment_id
+        WHERE ma.message_id IN ({",".join("?" * len(message_ids))})
+        ORDER BY ma.rowid
+    """, message_ids)
+    files: Dict[int, list] = {}
+    for msg_id, attachment_id, name, size, content_type in cur.fetchall():
+        files.setdefault(msg_id, []).append(attachment_info(attachment_id, name, size, content_type))
+    return files
+
+def attachment_info(attachment_id: str, name: str, size: int, content_type: str) -> dict:
+    return {"id": attachment_id, "name": name, "size": size, "content_type": content_type}
+
+def with_attachments(msg: dict, files: Dict[int, list]) -> dict:
+    # Messages without files keep their usual shape (and binary layout).
+    attached = files.get(msg["id"])
+    if attached:
+        msg["attachments"] = attached
+    return msg
+
+def attachment_ids(value) -> Optional[Tuple[str, ...]]:
+    """The ids listed in a message, or None when the list is malformed."""
+    if value is None:
+        return ()
+    if (not isinstance(value, list) or len(value) > MAX_ATTACHMENTS
+            or not all(isinstance(v, str) and v for v in value)):
+        return None
+    return tuple(dict.fromkeys(value))
+
+def attachment_error(ids: Optional[Tuple[str, ...]]) -> str:
+    return f"attachments must be a list of at most {MAX_ATTACHMENTS} ids" if ids is None else "attachment not found"
+
+async def resolve_attachments(username: str, ids: Tuple[str, ...]) -> Optional[list]:
+    """Metadata of the attachments of a message, or None when username may
+    not send one of them."""
+    found = await db.read(readable_attachments, username, ids)
+    if len(found) < len(ids):
+        return None
+    return [attachment_info(i, found[i][2], found[i][1], found[i][3]) for i in ids]
+
+@app.post("/attachments")
+async def upload_attachment(request: Request, name: str = "", user: str = Depends(current_user)):
+    """Store the raw request body as an attachment. The file name comes in
+    ?name= and its type in Content-Type; the body may be chunked."""
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_ATTACHMENT:
+        raise HTTPException(413, f"attachments are limited to {MAX_ATTACHMENT} bytes")
+    try:
+        sha256, size, new = await store.save(request.stream())
+    except ValueError as e:
+        raise HTTPException(413, str(e))
+    attachment_id = secrets.token_urlsafe(16)
+    name = clean_name(name) or attachment_id
+    content_type = request.headers.get("content-type") or "application/octet-stream"
+    await db.write(insert_attachment, attachment_id, sha256, size, name, content_type, user)
+    return {"ok": True, **attachment_info(attachment_id, name, size, content_type), "sha256": sha256, "new_blob": new}
+
+@app.get("/attachments/{attachment_id}")
+async def download_attachment(attachment_id: str, user: str = Depends(current_user)):
+    """The file, with Range support. Unknown and forbidden ids both 404."""
+    found = await db.read(readable_attachments, user, (attachment_id,))
+    if attachment_id not in found:
+        raise HTTPException(404, "attachment not found")
+    sha256, _, name, content_type = found[attachment_id]
+    # Always a download, never rendered inline: the type is whatever the
+    # uploader claimed.
+    return FileResponse(store.blob_path(sha256), media_type=content_type, filename=name,
+                        headers={"X-Content-Type-Options": "nosniff",
+                                 "Cache-Control": "private, max-age=31536000, immutable"})
+
+def fts_query(q: str) -> str:
+    # Every word becomes a quoted FTS5 term, so user input can't inject query
+    # syntax; a trailing * keeps prefix search.
+    terms = []
+    for word in q.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+def search_messages(conn, username: str, query: str, limit: int, offset: int):
+    # Ranking every match of a common word would cost time proportional to
+    # the whole history, so only the SEARCH_CANDIDATES most recent matches in
+    # the user's DMs and groups are ranked. Snippets are then built for the
+    # returned page only; they mark hits with [ ].
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, sender, target_type, target, ts FROM (
+            SELECT m.id, m.sender, m.target_type, m.target, m.ts, messages_fts.rank AS rank
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+              AND (m.conv IN (SELECT 'g:' || group_id FROM group_members WHERE username=?)
+                   OR (m.target_type='user' AND (m.sender=? OR m.target=?)))
+            ORDER BY messages_fts.rowid DESC LIMIT ?
+        )
+        ORDER BY rank LIMIT ? OFFSET ?
+    """, (query, username, username, username, SEARCH_CANDIDATES, limit + 1, offset))
+    rows = cur.fetchall()
+    ids = [r[0] for r in rows[:limit]]
+    snippets = {}
+    if ids:
+        cur.execute(f"""
+            SELECT rowid, snippet(messages_fts, 0, '[', ']', '…', 12) FROM messages_fts
+            WHERE messages_fts MATCH ? AND rowid IN ({",".join("?" * len(ids))})
+        """, [query] + ids)
+        snippets = dict(cur.fetchall())
+    return [r + (snippets.get(r[0]),) for r in rows]
+
+@app.get("/search/{username}", dependencies=[Depends(own_user)])
+def search(username: str, q: str, limit: int = PAGE_SIZE, offset: int = Query(0, le=MAX_MESSAGE_ID)):
+    query = fts_query(q)
+    if not query:
+        raise HTTPException(400, "q required")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    with db.reader("search_messages") as conn:
+        rows = search_messages(conn, username, query, limit, offset)
+        archived = archived_since(conn, username, 0)
+    results = []
+    for r in rows[:limit]:
+        peer = r[3] if r[2] != "user" or r[1] == username else r[1]
+        results.append({"id": r[0], "sender": r[1], "target_type": r[2], "target": peer, "ts": r[4], "snippet": r[5]})
+    # Only the hot table is indexed for search; archived tells the client that
+    # older messages of this user were not searched.
+    return {"results": results, "next_offset": offset + limit if len(rows) > limit else None,
+            "archived": archived}
+
+# ---------------- Export / Import ----------------
+# Both sides hold at most one batch in memory. The export reads in keyset
+# batches, each in its own short read transaction, so a long export never
+# pins a WAL snapshot, and it stops at the newest id that existed when it
+# started. The import parses the request body as it arrives and commits
+# every IMPORT_BATCH rows, so the client is only read as fast as rows land.
+# The whole-database export and the import take RUBYRUBY_ADMIN_TOKEN.
+
+def max_message_id(conn) -> int:
+    return conn.execute("SELECT coalesce(max(id), 0) FROM messages").fetchone()[0]
+
+def fetch_export_batch(conn, conv: Optional[str], after_id: int, upto: int, limit: int):
+    cur = conn.cursor()
+    if conv is None:
+        cur.execute("""
+            SELECT id, sender, target_type, target, text, ts FROM messages
+            WHERE id>? AND id<=? ORDER BY id LIMIT ?
+        """, (after_id, upto, limit))
+    else:
+        cur.execute("""
+            SELECT id, sender, target_type, target, text, ts FROM messages
+            WHERE conv=? AND id>? AND id<=? ORDER BY id LIMIT ?
+        """, (conv, after_id, upto, limit))
+    return cur.fetchall()
+
+def ndjson(rows) -> str:
+    return "".join(json.dumps({"id": r[0], "sender": r[1], "target_type": r[2], "target": r[3], "text": r[4], "ts": r[5]}) + "\n"
+                   for r in rows)
+
+def archived_convs(conn, after_id: int) -> List[str]:
+    return [r[0] for r in conn.execute(
+        "SELECT DISTINCT conv FROM archive_blocks WHERE last_id>? ORDER BY conv", (after_id,))]
+
+def export_lines(conv: Optional[str], after_id: int):
+    with db.reader("max_message_id") as conn:
+        upto = max_message_id(conn)
+        convs = [conv] if conv is not None else archived_convs(conn, after_id)
+    # Archived messages come first, one conversation at a time; each
+    # conversation's archived ids all precede its hot ones.
+    for key in convs:
+        since = after_id
+        while True:
+            with db.reader("archive_after") as conn:
+                rows = archive.after(conn, key, since, EXPORT_BATCH)
+            if not rows:
+                break
+            yield ndjson(rows)
+            since = rows[-1][0]
+    while after_id < upto:
+        with db.reader("fetch_export_batch") as conn:
+            rows = fetch_export_batch(conn, conv, after_id, upto, EXPORT_BATCH)
+        if not rows:
+            return
+        yield ndjson(rows)
+        after_id = rows[-1][0]
+
+@app.get("/export/messages", dependencies=[Depends(operator)])
+def export_all(after_id: int = Query(0, le=MAX_MESSAGE_ID)):
+    """Every message with id > after_id as NDJSON: the archived ones first,
+    conversation by conversation, then the hot table. Each conversation
+    comes out in id order, which is what the import needs."""
+    return StreamingResponse(export_lines(None, after_id), media_type="application/x-ndjson")
+
+@app.get("/export/messages/{username}/{target_type}/{target}", dependencies=[Depends(own_user)])
+def export_conversation(username: str, target_type: str, target: str, after_id: int = Query(0, le=MAX_MESSAGE_ID)):
+    with db.reader("check_member") as conn:
+        check_member(conn, username, target_type, target)
+    conv = conversation_key(username, target_type, target)
+    return StreamingResponse(export_lines(conv, after_id), media_type="application/x-ndjson")
+
+def parse_import_line(line: bytes):
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError("each line must be a JSON object")
+    sender, target_type, target, text = row.get("sender"), row.get("target_type"), row.get("target"), row.get("text")
+    if not sender or target_type not in ("user", "group") or target is None or not isinstance(text, str):
+        raise ValueError("sender, target_type, target and text required")
+    msg_id = row.get("id")
+    if msg_id is not None and not isinstance(msg_id, int):
+        raise ValueError("id must be an integer")
+    ts = row.get("ts")
+    if ts is not None and not is_timestamp(ts):
+        raise ValueError("ts must be null or \"YYYY-MM-DD HH:MM:SS\"")
+    return msg_id, sender, target_type, str(target), text, ts
+
+def is_timestamp(ts) -> bool:
+    # The format SQLite's CURRENT_TIMESTAMP writes; the archiver compares
+    # timestamps as text.
+    if not isinstance(ts, str) or len(ts) != 19:
+        return False
+    try:
+        datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return False
+    return True
+
+@app.post("/import/messages", dependencies=[Depends(operator)])
+async def import_history(request: Request, preserve_ids: bool = False):
+    """Load NDJSON as written by /export/messages. Rows should come in id
+    order; with preserve_ids the exported ids are kept and rows already
+    present are skipped. On a bad line, every line before it is imported
+    and the error names the line."""
+    imported = 0
+    line_no = 0
+    rows = []
+    buf = b""
+    async def flush():
+        nonlocal imported, rows
+        if rows:
+            imported += await db.write(import_messages, rows, preserve_ids)
+            rows = []
+    try:
+        async for chunk in request.stream():
+            *lines, buf = (buf + chunk).split(b"\n")
+            for line in lines:
+                line_no += 1
+                if line.strip():
+                    rows.append(parse_import_line(line))
+                if len(rows) >= IMPORT_BATCH:
+                    await flush()
+            if len(buf) > MAX_IMPORT_LINE:
+                line_no += 1
+                raise ValueError("line too long")
+        if buf.strip():
+            line_no += 1
+            rows.append(parse_import_line(buf))
+    except ValueError as e:
+        await flush()
+        return JSONResponse({"ok": False, "error": f"line {line_no}: {e}", "imported": imported}, status_code=400)
+    await flush()
+    return {"ok": True, "imported": imported}
+
+# ---------------- WebSocket ----------------
+def fetch_group_members(conn, group_id: str):
+    cur = conn.cursor()
+    cur.execute("SELECT username FROM group_members WHERE group_id=?", (group_id,))
+    return [r[0] for r in cur.fetchall()]
+
+class GroupMemberships:
+    """In-memory group_id -> members index.
+
+    A group is read from the database the first time it is broadcast to;
+    afterwards create_group/join_group keep it current. Adds that land
+    before the first load are kept and merged with what the load returns.
+    """
+
+    def __init__(self):
+        self.members: Dict[str, set] = {}
+        self.loaded: set = set()
+        self.lock = threading.Lock()
+
+    def create(self, group_id, username: str):
+        with self.lock:
+            self.members[str(group_id)] = {username}
+            self.loaded.add(str(group_id))
+
+    def add(self, group_id, username: str):
+        with self.lock:
+            self.members.setdefault(str(group_id), set()).add(username)
+
+    async def get(self, group_id) -> tuple:
+        group_id = str(group_id)
+        with self.lock:
+            if group_id in self.loaded:
+                return tuple(self.members[group_id])
+        rows = await db.read(fetch_group_members, group_id)
+        with self.lock:
+            members = self.members.setdefault(group_id, set())
+            members.update(rows)
+            self.loaded.add(group_id)
+            return tuple(members)
+
+memberships = GroupMemberships()
+
+class Connection:
+    """One WebSocket session with its own bounded outbound queue.
+
+    push() never blocks: frames are queued and a dedicated writer task sends
+    them, so a slow socket only ever delays itself. When the queue is full
+    the slow-consumer policy decides what happens:
+
+    - "drop_oldest": discard the oldest queued frame; the client is told how
+      many were dropped before the next frame it receives.
+    - "coalesce": collapse the whole queue into a single {"type": "resync"}
+      telling the client to refetch history, then keep queueing after it.
+    - "disconnect": close the socket.
+
+    Frames are queued as JSON text. A session speaking the binary protocol
+    gets everything queued at write time, up to BATCH_FRAMES, as one frame.
+    """
+
+    def __init__(self, username: str, ws: WebSocket, binary: bool = False,
+                 policy: str = SLOW_CONSUMER_POLICY, maxsize: int = OUTBOUND_QUEUE_SIZE):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"unknown slow consumer policy: {policy}")
+        self.username = username
+        self.ws = ws
+        self.binary = binary
+        self.policy = policy
+        self.maxsize = maxsize
+        self.queue: Deque[Tuple[str, Optional[int]]] = deque()   # (frame, message id)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.delivered = 0   # highest message id written to this socket
+        self.saved = 0       # highest id recorded in delivery_cursors
+        self.skip_through = 0   # live messages at or below this id came in the backlog
+        self.closed = False
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def push(self, data: str, msg_id: Optional[int] = None):
+        if self.closed:
+            return
+        if len(self.queue) >= self.maxsize:
+            if self.policy == "disconnect":
+                self.close(1013)
+                return
+            if self.policy == "drop_oldest":
+                self.queue.popleft()
+                self.dropped += 1
+                FRAMES_DROPPED.inc(self.policy)
+            else:
+                self.dropped += len(self.queue)
+                FRAMES_DROPPED.inc(self.policy, amount=len(self.queue))
+                self.queue.clear()
+                self.queue.append((json.dumps({"type": "resync"}), None))
+        self.queue.append((data, msg_id))
+        self.ready.set()
+
+    async def run(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                if not self.queue:
+                    self.ready.clear()
+                    continue
+                items = []
+                if self.dropped and self.policy == "drop_oldest":
+                    dropped, self.dropped = self.dropped, 0
+                    items.append(json.dumps({"type": "dropped", "count": dropped}))
+                limit = BATCH_FRAMES if self.binary else 1
+                size = last_id = 0
+                while self.queue and len(items) < limit and size < BATCH_BYTES:
+                    data, msg_id = self.queue.popleft()
+                    if msg_id is not None:
+                        if msg_id <= self.skip_through:
+                            continue
+                        last_id = max(last_id, msg_id)
+                    items.append(data)
+                    size += len(data)
+                if self.binary and items:
+                    await self.write(encode_frame([record_from_json(data) for data in items]))
+                else:
+                    for data in items:
+                        await self.write(data)
+                if last_id > self.delivered:
+                    self.delivered = last_id
+        except Exception as e:
+            # A timed-out send may have left a partial frame; the socket is
+            # unusable after that, so drop the session.
+            logger.info("closing connection of %s: %r", self.username, e)
+            self.close(1011)
+
+    async def write(self, frame):
+        if isinstance(frame, bytes):
+            await asyncio.wait_for(self.ws.send_bytes(frame), SEND_TIMEOUT)
+        else:
+            await asyncio.wait_for(self.ws.send_text(frame), SEND_TIMEOUT)
+        FRAMES_SENT.inc()
+        BYTES_SENT.inc("binary" if self.binary else "json", amount=len(frame))
+
+    async def send_now(self, message: dict):
+        """Write message ahead of the queue; used for the catch-up before start()."""
+        await self.write(encode_frame([encode_record(message)]) if self.binary else json.dumps(message))
+
+    def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.ready.set()
+        asyncio.create_task(self._close(code))
+
+    async def _close(self, code: int):
+        try:
+            await self.ws.close(code)
+        except Exception:
+            pass
+
+    def stop(self):
+        # Waking the writer as well as cancelling it: on 3.11 a cancel that
+        # races with wait_for() completing can be swallowed.
+        self.closed = True
+        self.queue.clear()
+        self.ready.set()
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+def fetch_backlog(conn, username: str, after_id: int, limit: int):
+    # One index range per source, each read in id order and cut at limit:
+    # DMs received and every group through the covering idx_messages_target,
+    # DMs sent through idx_messages_sender. Their ids are merged here, and
+    # only the first limit rows are read in full, so a batch never gathers
+    # and sorts everything since after_id.
+    cur = conn.cursor()
+    groups = [r[0] for r in cur.execute(
+        "SELECT CAST(group_id AS TEXT) FROM group_members WHERE username=?", (username,))]
+    ranges = [("user", username)] + [("group", g) for g in groups]
+    sources = [[r[0] for r in cur.execute("""
+        SELECT id FROM messages WHERE target_type=? AND target=? AND id>? ORDER BY id LIMIT ?
+    """, (target_type, target, after_id, limit))] for target_type, target in ranges]
+    sources.append([r[0] for r in cur.execute("""
+        SELECT id FROM messages WHERE sender=? AND target_type='user' AND target!=? AND id>? ORDER BY id LIMIT ?
+    """, (username, username, after_id, limit))])
+    ids = list(heapq.merge(*sources))[:limit]
+    if not ids:
+        return []
+    cur.execute(f"""
+        SELECT id, sender, target_type, target, text, ts FROM messages
+        WHERE id IN ({",".join("?" * len(ids))}) ORDER BY id
+    """, ids)
+    return cur.fetchall()
+
+def archived_since(conn, username: str, since: int) -> bool:
+    # Whether one of username's own conversations has archived messages after
+    # since. Every DM and group of a user has a read marker, and each is one
+    # probe of idx_archive_blocks_conv.
+    return conn.execute("""
+        SELECT 1 FROM read_markers r JOIN archive_blocks b ON b.conv = r.conv AND b.last_id > ?
+        WHERE r.username=? LIMIT 1
+    """, (since, username)).fetchone() is not None
+
+def fetch_scope(conn, username: str) -> List[str]:
+    # Whose presence username sees: its contacts and everyone in its groups.
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT contact FROM contacts WHERE owner=?
+        UNION
+        SELECT username FROM group_members
+        WHERE group_id IN (SELECT group_id FROM group_members WHERE username=?)
+    """, (username, username))
+    return [r[0] for r in cur.fetchall()]
+
+def fetch_cursor(conn, username: str) -> Optional[int]:
+    cur = conn.cursor()
+    cur.execute("SELECT last_id FROM delivery_cursors WHERE username=?", (username,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def save_cursors(conn, cursors):
+    conn.executemany("""
+        INSERT INTO delivery_cursors (username, last_id) VALUES (?, ?)
+        ON CONFLICT(username) DO UPDATE SET last_id=max(last_id, excluded.last_id)
+    """, cursors)
+
+class WSManager:
+    """Live sessions on this worker by username; a user may be connected
+    from several devices. Frames for other workers go through the bus."""
+
+    def __init__(self):
+        self.connections: Dict[str, Set[Connection]] = {}
+        self.retired: Dict[str, int] = {}   # cursors of closed sessions not yet saved
+        self.lock = threading.Lock()
+
+    async def connect(self, username: str, ws: WebSocket) -> Connection:
+        # The session receives live frames from here on, but they stay
+        # queued until the caller starts it after the catch-up.
+        binary = PROTOCOL in ws.scope.get("subprotocols", ())
+        await ws.accept(subprotocol=PROTOCOL if binary else None)
+        conn = Connection(username, ws, binary)
+        with self.lock:
+            sessions = self.connections.setdefault(username, set())
+            first = not sessions
+            sessions.add(conn)
+        if first:
+            bus.online(username)
+        return conn
+
+    def disconnect(self, conn: Connection):
+        conn.stop()
+        last = False
+        with self.lock:
+            sessions = self.connections.get(conn.username)
+            if sessions is not None:
+                sessions.discard(conn)
+                if not sessions:
+                    del self.connections[conn.username]
+                    last = True
+            if conn.delivered > conn.saved:
+                self.retired[conn.username] = max(self.retired.get(conn.username, 0), conn.delivered)
+        if last:
+            presence.unsubscribe(conn.username)
+            bus.offline(conn.username)
+
+    def deliver(self, usernames, data: str, msg_id: Optional[int] = None):
+        for username in usernames:
+            for conn in self.connections.get(username, ()):
+                conn.push(data, msg_id)
+
+    async def send(self, usernames: Tuple[str, ...], message: dict):
+        self.send_text(usernames, json.dumps(message), msg_id=message_id(message))
+
+    def send_text(self, usernames: Tuple[str, ...], data: str, msg_id: Optional[int] = None):
+        bus.publish(usernames, data, msg_id)
+
+    async def broadcast_group(self, group_id: str, message: dict):
+        with BROADCAST_TIME.time():
+            members = await memberships.get(group_id)
+            # Serialize once; the bus skips offline members and each session's
+            # writer delivers at its own pace.
+            bus.publish(members, json.dumps(message), msg_id=message_id(message))
+        BROADCAST_SIZE.observe(len(members))
+
+    async def send_backlog(self, conn: Connection, since: Optional[int]):
+        """Stream messages after since (or the saved cursor) to a new session
+        in batches, before it starts taking live frames."""
+        if since is None:
+            since = await db.read(fetch_cursor, conn.username)
+        if since is not None and await db.read(archived_since, conn.username, since):
+            # Some of what was missed may be archived already; the client
+            # pages it in over HTTP instead.
+            await conn.send_now({"type": "resync"})
+            since = None
+        sent = 0
+        while since is not None:
+            rows = await db.read(fetch_backlog, conn.username, since, BACKLOG_BATCH)
+            if not rows:
+                break
+            sent += len(rows)
+            if sent > MAX_BACKLOG:
+                await conn.send_now({"type": "resync"})
+                break
+            files = await db.read(fetch_message_attachments, [r[0] for r in rows])
+            msgs = [with_attachments({"type": "message", "id": r[0], "from": r[1], "target_type": r[2], "to": r[3],
+                                      "text": r[4], "ts": r[5]}, files)
+                    for r in rows]
+            await conn.send_now({"type": "backlog", "messages": msgs})
+            since = rows[-1][0]
+            if len(rows) < BACKLOG_BATCH:
+                break
+        conn.delivered = conn.skip_through = since or 0
+        await conn.send_now({"type": "backlog_done", "last_id": since})
+
+    async def send_presence(self, conn: Connection):
+        """Start presence diffs for the user if this is its first session
+        here, then give the session one snapshot of its whole scope."""
+        if conn.username not in presence.scopes:
+            scope = await db.read(fetch_scope, conn.username)
+            if conn.username in self.connections:
+                presence.subscribe(conn.username, scope)
+        await conn.send_now(presence.snapshot(conn.username))
+
+    def collect_cursors(self) -> Dict[str, int]:
+        with self.lock:
+            cursors, self.retired = self.retired, {}
+            for username, sessions in self.connections.items():
+                for conn in sessions:
+                    if conn.delivered > conn.saved:
+                        cursors[username] = max(cursors.get(username, 0), conn.delivered)
+                        conn.saved = conn.delivered
+        return cursors
+
+    async def flush_cursors(self):
+        cursors = self.collect_cursors()
+        if cursors:
+            await db.write(save_cursors, list(cursors.items()))
+
+    async def run_cursor_flusher(self):
+        # Delivery cursors are saved in one transaction every few seconds
+        # rather than once per delivered message.
+        while True:
+            await asyncio.sleep(CURSOR_FLUSH_SECONDS)
+            try:
+                await self.flush_cursors()
+            except Exception as e:
+                logger.warning("saving delivery cursors failed: %r", e)
+
+def message_id(message: dict) -> Optional[int]:
+    return message.get("id") if message.get("type") == "message" else None
+
+ws_manager = WSManager()
+
+async def fan_out(msg_id: int, sender: str, target_type: str, target: str, text: str, attached: Optional[list] = None):
+    payload = {"type": "message", "id": msg_id, "from": sender, "to": target, "text": text, "target_type": target_type}
+    if attached:
+        payload["attachments"] = attached
+    if target_type == "user":
+        # The sender's other sessions get the DM as well, or their stream
+        # would skip its id; the session that sent it drops the echo.
+        await ws_manager.send((target,) if target == sender else (target, sender), payload)
+    else:
+        await ws_manager.broadcast_group(target, payload)
+
+def contacts_added(pairs):
+    for owner, contact in pairs:
+        presence.watch(owner, (contact,))
+
+def groups_joined(members):
+    for group_id, username in members:
+        asyncio.create_task(watch_group(group_id, username))
+
+async def watch_group(group_id, username: str):
+    # The new member sees the group, and the group sees the new member.
+    members = await memberships.get(group_id)
+    presence.watch(username, members)
+    for member in members:
+        presence.watch(member, (username,))
+
+async def typing_recipients(username: str, target_type: str, target: str) -> tuple:
+    if target_type == "user":
+        return (target,)
+    members = await memberships.get(target)
+    return members if username in members else ()
+
+async def apply_typing(event: dict):
+    recipients = await typing_recipients(event["user"], event["target_type"], event["target"])
+    if not recipients and event["active"]:
+        return   # not a member of the group
+    presence.typing(event["user"], event["target_type"], event["target"], recipients, event["active"])
+
+async def set_typing(username: str, target_type: str, target: str, active: bool):
+    """Record a typing change here and on every other worker. Refreshes
+    within TYPING_REFRESH of the last one change nothing and are dropped."""
+    if presence.is_typing(username, target_type, target, refresh=active) == active:
+        return
+    event = {"type": "typing", "user": username, "target_type": target_type, "target": target, "active": active}
+    await apply_typing(event)
+    bus.broadcast_control(event)
+
+def on_control(event: dict):
+    # Control events come from other workers over the bus.
+    if event.get("type") == "member_added":
+        memberships.add(event["group_id"], event["user"])
+        groups_joined([(event["group_id"], event["user"])])
+    elif event.get("type") == "members_added":
+        for group_id, username in event["members"]:
+            memberships.add(group_id, username)
+        groups_joined(event["members"])
+    elif event.get("type") == "contacts_added":
+        contacts_added(event["contacts"])
+    elif event.get("type") == "typing":
+        asyncio.create_task(apply_typing(event))
+    elif event.get("type") == "session_revoked":
+        sessions.cache.discard(event["key"])
+    elif event.get("type") == "sessions_revoked":
+        sessions.cache.discard_user(event["user"])
+
+async def receive_messages(ws: WebSocket) -> List[dict]:
+    # A text frame is one JSON object; a binary frame may carry several.
+    # Raises ValueError on a frame that is neither.
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    FRAMES_RECEIVED.inc()
+    if message.get("bytes") is not None:
+        return decode_frame(message["bytes"])
+    msg = json.loads(message.get("text") or "")
+    if not isinstance(msg, dict):
+        raise ValueError("frame is not a JSON object")
+    return [msg]
+
+@app.websocket("/ws/{token}")
+async def websocket_endpoint(ws: WebSocket, token: str, since: Optional[int] = Query(None, ge=0, le=MAX_MESSAGE_ID)):
+    username = await sessions.validate(token)
+    if username is None:
+        # Closing before accept rejects the handshake with HTTP 403.
+        await ws.close(code=4401)
+        return
+    conn = await ws_manager.connect(username, ws)
+    limiter = Limiter(username, user_buckets, admission)
+    code = 1000
+    try:
+        await ws_manager.send_backlog(conn, since)
+        await ws_manager.send_presence(conn)
+        conn.start()
+        while True:
+            try:
+                msgs = await receive_messages(ws)
+            except ValueError as e:
+                conn.push(json.dumps({"type": "error", "ref": None, "error": f"bad frame: {e}"}))
+                continue
+            for msg in msgs:
+                if msg.get("type") == "typing":
+                    if msg.get("target_type") in ("user", "group") and msg.get("target") is not None:
+                        await set_typing(username, msg["target_type"], str(msg["target"]), msg.get("active", True) is not False)
+                    continue
+                if msg.get("type") == "message":
+                    allowed, notice = await limiter.check()
+                    if not allowed:
+                        if notice is not None:
+                            notice["ref"] = msg.get("ref")
+                            conn.push(json.dumps(notice))
+                        if limiter.abusive():
+                            logger.info("closing %s: over the rate limit %d times in a row", username, limiter.strikes)
+                            conn.close(1008)
+                            return
+                        continue
+                    target_type = msg.get("target_type")
+                    target = msg.get("target")
+                    text = msg.get("text")
+                    if target_type not in ("user", "group") or target is None or not isinstance(text, str):
+                        conn.push(json.dumps({"type": "error", "ref": msg.get("ref"),
+                                              "error": "target_type, target and text required"}))
+                        continue
+                    target = str(target)
+                    ids = attachment_ids(msg.get("attachments"))
+                    attached = await resolve_attachments(username, ids) if ids else []
+                    if ids is None or attached is None:
+                        conn.push(json.dumps({"type": "error", "ref": msg.get("ref"), "error": attachment_error(ids)}))
+                        continue
+                    try:
+                        msg_id = await writer.submit(username, target_type, target, text, ids)
+                    except Exception:
+                        conn.push(json.dumps({"type": "error", "ref": msg.get("ref"), "error": "message not stored"}))
+                        continue
+                    conn.push(json.dumps({"type": "ack", "ref": msg.get("ref"), "id": msg_id}))
+                    await fan_out(msg_id, username, target_type, target, text, attached)
+                    if presence.is_typing(username, target_type, target):
+                        await set_typing(username, target_type, target, False)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.info("websocket of %s failed: %r", username, e)
+        code = 1011
+    finally:
+        ws_manager.disconnect(conn)
+        # Sends a close frame unless the socket is closed already.
+        conn.close(code)
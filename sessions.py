@@ -0,0 +1,141 @@
+# sessions.py
+# Login sessions: random opaque tokens stored in the sessions table with an
+# expiry, checked through a bounded LRU cache with a TTL so that the check
+# on every connect and authenticated HTTP call is normally a dict lookup.
+#
+# Only a SHA-256 of each token is stored or cached, so the database never
+# holds a usable token. Revoking a session drops it from this worker's
+# cache at once; other workers hear about it through a bus control event
+# and, failing that, stop trusting their copy after CACHE_TTL.
+
+import asyncio
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from metrics import Counter
+
+SESSION_TTL = 30 * 24 * 3600   # seconds a login stays valid
+CACHE_SIZE = 10000             # sessions remembered per worker
+CACHE_TTL = 60.0               # seconds a cached lookup is trusted
+NEGATIVE_TTL = 5.0             # seconds an unknown token is remembered as invalid
+
+LOOKUPS = Counter("rubyruby_session_lookups_total", "Session token checks by cache outcome.", ("result",))
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# ---------------- Storage ----------------
+def create_session(conn, username: str, key: str, expires_at: float):
+    now = time.time()
+    conn.execute("DELETE FROM sessions WHERE expires_at<?", (now,))
+    conn.execute("INSERT INTO sessions (token_hash, username, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                 (key, username, now, expires_at))
+
+def fetch_session(conn, key: str) -> Optional[Tuple[str, float]]:
+    return conn.execute("SELECT username, expires_at FROM sessions WHERE token_hash=?", (key,)).fetchone()
+
+def delete_session(conn, key: str):
+    conn.execute("DELETE FROM sessions WHERE token_hash=?", (key,))
+
+def delete_user_sessions(conn, username: str):
+    conn.execute("DELETE FROM sessions WHERE username=?", (username,))
+
+# ---------------- Cache ----------------
+class SessionCache:
+    """LRU of token hash -> (username or None, session expiry, trusted until).
+
+    Used from the event loop and from threadpool routes, hence the lock.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self.entries: "OrderedDict[str, Tuple[Optional[str], float, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Optional[str]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            username, expires_at, trusted_until = entry
+            if time.monotonic() >= trusted_until:
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+        if username is not None and time.time() >= expires_at:
+            return True, None
+        return True, username
+
+    def put(self, key: str, username: Optional[str], expires_at: float = 0.0):
+        ttl = CACHE_TTL if username is not None else NEGATIVE_TTL
+        with self.lock:
+            self.entries[key] = (username, expires_at, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_user(self, username: str):
+        with self.lock:
+            for key in [k for k, (u, _, _) in self.entries.items() if u == username]:
+                del self.entries[key]
+
+class Sessions:
+    def __init__(self, db, ttl: float = SESSION_TTL, cache_size: int = CACHE_SIZE):
+        self.db = db
+        self.ttl = ttl
+        self.cache = SessionCache(cache_size)
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+    async def create(self, username: str) -> Tuple[str, float]:
+        token = secrets.token_urlsafe(32)
+        key = token_hash(token)
+        expires_at = time.time() + self.ttl
+        await self.db.write(create_session, username, key, expires_at)
+        self.cache.put(key, username, expires_at)
+        return token, expires_at
+
+    async def validate(self, token: str) -> Optional[str]:
+        """Username of a live session, or None."""
+        key = token_hash(token)
+        hit, username = self.cache.get(key)
+        if hit:
+            LOOKUPS.inc("hit")
+            return username
+        # A reconnect storm brings many sockets with the same token at once;
+        # they share one database lookup.
+        fut = self.inflight.get(key)
+        if fut is not None:
+            LOOKUPS.inc("shared")
+            return await asyncio.shield(fut)
+        LOOKUPS.inc("miss")
+        fut = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            row = await self.db.read(fetch_session, key)
+            username, expires_at = row if row and row[1] > time.time() else (None, 0.0)
+            self.cache.put(key, username, expires_at)
+            fut.set_result(username)
+            return username
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()   # retrieved here so a lone lookup doesn't log it as unhandled
+            raise
+        finally:
+            del self.inflight[key]
+
+    async def revoke(self, token: str) -> str:
+        key = token_hash(token)
+        self.cache.discard(key)
+        await self.db.write(delete_session, key)
+        return key
+
+    async def revoke_user(self, username: str):
+        self.cache.discard_user(username)
+        await self.db.write(delete_user_sessions, username)